@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import argparse
+
+__all__ = ['generate_tables', 'TABLE_FILES']
+
+TABLE_FILES = ('virtual-alias', 'sender-login-maps', 'virtual-mailbox-users', 'virtual-mailbox-domains')
+
+CONFIG = """postmap: %(postmap)s
+filesystem:
+  files:
+    virtual-alias: ./virtual-alias
+    sender-login-maps: ./sender-login-maps
+    virtual-mailbox-domains: ./virtual-mailbox-domains
+    virtual-mailbox-users: ./virtual-mailbox-users
+"""
+
+POSTMAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'postmap')
+
+
+def _comment(rnd, file, density):
+    if rnd.random() < density:
+        file.write('# Ticket %s, requested by %s\n' % (rnd.randrange(100000), rnd.choice(('ops', 'hr', 'it'))))
+
+
+def generate_tables(directory, entries, domains=10, aliases_per_inbox=5, comment_density=0.05, deleted=0.01,
+                    seed=0):
+    # Writes the four tables and a config.yaml using them into directory and returns the config path.
+    # virtual-alias gets the given number of entries pointing to entries / aliases_per_inbox inboxes,
+    # sender-login-maps the same aliases in a different order.
+    rnd = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    domain_names = ['domain%s.example' % i for i in range(max(domains, 1))]
+    inboxes = ['user%s@%s' % (i, rnd.choice(domain_names)) for i in range(max(entries // aliases_per_inbox, 1))]
+    aliases = ['alias%s@%s' % (i, rnd.choice(domain_names)) for i in range(entries)]
+    owners = [rnd.choice(inboxes) for _ in aliases]
+
+    def write_table(name, items):
+        with open(os.path.join(directory, name), 'w') as file:
+            file.write('# Generated benchmark table\n\n')
+            for key, value in items:
+                _comment(rnd, file, comment_density)
+                if rnd.random() < deleted:
+                    file.write('#-- %s\t%s\n' % (key, value))
+                else:
+                    file.write('%s\t%s\n' % (key, value))
+
+    write_table('virtual-alias', zip(aliases, owners))
+    order = list(range(entries))
+    rnd.shuffle(order)
+    write_table('sender-login-maps', ((aliases[i], owners[i]) for i in order))
+    write_table('virtual-mailbox-users', ((inbox, 'OK') for inbox in inboxes))
+    write_table('virtual-mailbox-domains', ((domain, 'OK') for domain in domain_names))
+
+    path = os.path.join(directory, 'config.yaml')
+    with open(path, 'w') as file:
+        file.write(CONFIG % {'postmap': POSTMAP})
+    return path
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generates Postfix tables for the benchmarks.')
+    parser.add_argument('directory')
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--domains', type=int, default=10)
+    parser.add_argument('--aliases-per-inbox', type=int, default=5)
+    parser.add_argument('--comment-density', type=float, default=0.05)
+    parser.add_argument('--deleted', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+    print(generate_tables(args.directory, args.entries, args.domains, args.aliases_per_inbox,
+                          args.comment_density, args.deleted, args.seed))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
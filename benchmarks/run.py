@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import importlib
+import tempfile
+import tracemalloc
+import subprocess
+
+import postfixhelper
+from benchmarks.generate import generate_tables
+
+__all__ = ['BENCHMARKS', 'run', 'compare']
+
+DEFAULT_SIZES = [10000]
+DEFAULT_THRESHOLD = 1.2
+# Seconds a CLI run may take before it touches a table: interpreter start, imports and argument parsing
+STARTUP_BUDGET = 0.15
+STARTUP_CODE = 'import sys, postfixhelper, help; postfixhelper.parse_args(help.Help, sys.argv)'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _fresh(config_file):
+    # Tables are singletons and the config is module state, so every measurement starts from a reloaded module
+    importlib.reload(postfixhelper)
+    postfixhelper.load_file_config(config_file=config_file)
+    return postfixhelper
+
+
+def _count_entries(ph):
+    return len(ph.PostfixTable('virtual-alias'))
+
+
+def setup_parse(config_file):
+    ph = _fresh(config_file)
+    path = ph.FILE_CONFIG['virtual-alias']
+
+    def parse():
+        table = {}
+        with open(path) as file:
+            ph.PostfixTableParser().parse(file, table)
+        return len(table)
+    return parse
+
+
+def setup_serialize(config_file):
+    ph = _fresh(config_file)
+    table = ph.PostfixTable('virtual-alias')
+    len(table)
+    return table.serialize
+
+
+def setup_get_alias_list(config_file):
+    ph = _fresh(config_file)
+    alias_config = ph.PFAliasConfig()
+    len(alias_config._virtual_alias)
+    len(alias_config._sender_login_maps)
+    return lambda: alias_config.get_alias_list(True, True)
+
+
+def setup_list_aliases(config_file):
+    ph = _fresh(config_file)
+    app = ph.App()
+    len(app._alias_config._virtual_alias)
+    len(app._alias_config._sender_login_maps)
+    return lambda: app.list_aliases(argparse.Namespace(as_saved=False))
+
+
+def setup_save(config_file):
+    ph = _fresh(config_file)
+    app = ph.App()
+    alias_config = app._alias_config
+    user = next(key for key, entry in alias_config._users.items() if key is not None and not entry.deleted)
+    alias = 'benchmark-%s@%s' % (time.monotonic_ns(), user.partition('@')[2])
+    alias_config.add_alias(alias, user)
+    return lambda: app._save_alias_tables(argparse.Namespace(save=True))
+
+
+# name -> setup(config_file) returning the callable to measure
+BENCHMARKS = {
+    'parse': setup_parse,
+    'serialize': setup_serialize,
+    'get_alias_list': setup_get_alias_list,
+    'list_aliases': setup_list_aliases,
+    'save_alias_tables': setup_save,
+}
+
+
+def measure(setup, config_file, repeat=3, memory=True):
+    times = []
+    for _ in range(repeat):
+        fn = setup(config_file)
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    result = {'seconds': min(times), 'mean_seconds': sum(times) / len(times)}
+    if memory:
+        # tracemalloc slows everything down, so peak memory gets a run of its own
+        fn = setup(config_file)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def measure_startup(repeat=3, argv=('alias', 'list')):
+    times = []
+    for _ in range(max(repeat, 3)):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', STARTUP_CODE] + list(argv), cwd=ROOT, check=True)
+        times.append(time.perf_counter() - start)
+    return {'operation': 'startup', 'size': 0, 'entries': None, 'entries_per_second': None, 'peak_bytes': None,
+            'seconds': min(times), 'mean_seconds': sum(times) / len(times)}
+
+
+def _version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, names=None, repeat=3, memory=True, directory=None, generator_args=None, log=None, startup=True):
+    names = list(BENCHMARKS) if names is None else [name for name in names if name in BENCHMARKS]
+    results = {'version': _version(), 'python': platform.python_version(), 'time': time.time(), 'results': []}
+    if startup:
+        results['results'].append(measure_startup(repeat))
+        if log is not None:
+            print(format_result(results['results'][-1]), file=log)
+    work_dir = directory or tempfile.mkdtemp(prefix='pfh-bench-')
+    try:
+        for size in sizes if names else []:
+            config_file = generate_tables(os.path.join(work_dir, str(size)), size, **(generator_args or {}))
+            entries = _count_entries(_fresh(config_file))
+            for name in names:
+                result = measure(BENCHMARKS[name], config_file, repeat, memory)
+                result.update({'operation': name, 'size': size, 'entries': entries,
+                               'entries_per_second': entries / result['seconds'] if result['seconds'] else None})
+                results['results'].append(result)
+                if log is not None:
+                    print(format_result(result), file=log)
+    finally:
+        if directory is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def format_result(result):
+    peak = result.get('peak_bytes')
+    if result['entries_per_second'] is None:
+        return '%-18s %10s  %10.4fs' % (result['operation'], '', result['seconds'])
+    return '%-18s %10d  %10.4fs  %12.0f entries/s  %s' % (
+        result['operation'], result['size'], result['seconds'], result['entries_per_second'] or 0,
+        '%.1f MiB' % (peak / 1048576) if peak is not None else '-')
+
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    # Returns lines describing the change per operation and whether one got slower than threshold allows
+    baseline = {(r['operation'], r['size']): r for r in old['results']}
+    lines = []
+    regression = False
+    for result in new['results']:
+        before = baseline.get((result['operation'], result['size']))
+        if before is None or not before['seconds']:
+            continue
+        ratio = result['seconds'] / before['seconds']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regression = True
+        lines.append('%-18s %10d  %10.4fs -> %10.4fs  x%.2f%s' % (
+            result['operation'], result['size'], before['seconds'], result['seconds'], ratio, flag))
+    return lines, regression
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks parsing, serializing, listing and saving tables.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Number of entries of the generated tables, e.g. 10000 100000 1000000.')
+    parser.add_argument('--only', nargs='+', choices=['startup'] + list(BENCHMARKS),
+                        help='Run only these benchmarks.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help="Don't measure peak memory.")
+    parser.add_argument('--dir', help='Keep the generated tables in this directory.')
+    parser.add_argument('--domains', type=int, default=10)
+    parser.add_argument('--aliases-per-inbox', type=int, default=5)
+    parser.add_argument('--comment-density', type=float, default=0.05)
+    parser.add_argument('--deleted', type=float, default=0.01)
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='Compare with results written by an earlier run.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Slowdown factor reported as regression by --compare.')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET,
+                        help='Fail if starting the CLI takes longer than this many seconds.')
+    args = parser.parse_args(argv[1:])
+
+    generator_args = {'domains': args.domains, 'aliases_per_inbox': args.aliases_per_inbox,
+                      'comment_density': args.comment_density, 'deleted': args.deleted}
+    results = run(args.sizes, args.only, args.repeat, not args.no_memory, args.dir, generator_args, sys.stdout,
+                  startup=not args.only or 'startup' in args.only)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    status = 0
+    startup = [r['seconds'] for r in results['results'] if r['operation'] == 'startup']
+    if startup and startup[0] > args.startup_budget:
+        print('Startup took %.3fs, the budget is %.3fs.' % (startup[0], args.startup_budget))
+        status = 1
+    if args.compare:
+        with open(args.compare) as file:
+            lines, regression = compare(json.load(file), results, args.threshold)
+        print('\n'.join(lines))
+        if regression:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+import time
+import logging
+import hashlib
+import marshal
+
+__all__ = ['SnapshotCache']
+
+
+class SnapshotCache(object):
+    version = 2
+    suffix = '.snapshot'
+    max_age = 30 * 24 * 60 * 60
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+
+    def _snapshot_path(self, f_path):
+        name = hashlib.sha1(os.path.abspath(f_path).encode()).hexdigest()
+        return os.path.join(self.directory, name + self.suffix)
+
+    @staticmethod
+    def file_id(f_path):
+        stat = os.stat(f_path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def content_hash(f_path):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(f_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    @staticmethod
+    def _read_header(file):
+        header = marshal.load(file)
+        if not isinstance(header, tuple) or len(header) != 4:
+            raise ValueError('Invalid snapshot header')
+        return header
+
+    def load(self, f_path):
+        # Returns the records stored for f_path or None if there is no valid snapshot
+        path = self._snapshot_path(f_path)
+        try:
+            with open(path, 'rb') as file:
+                version, source, file_id, content_hash = self._read_header(file)
+                if version != self.version or source != os.path.abspath(f_path) or \
+                        tuple(file_id) != self.file_id(f_path) or content_hash != self.content_hash(f_path):
+                    raise ValueError('Stale snapshot')
+                records = marshal.load(file)
+            os.utime(path)
+            return records
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError):
+            self._remove(path)
+            return None
+
+    def store(self, f_path, records, file_id):
+        # file_id has to be taken before the file was parsed, so changes made meanwhile aren't cached
+        try:
+            if self.file_id(f_path) != file_id:
+                return False
+            header = (self.version, os.path.abspath(f_path), file_id, self.content_hash(f_path))
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._snapshot_path(f_path)
+            tmp_path = '%s.%s.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as file:
+                marshal.dump(header, file)
+                marshal.dump(records, file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("Couldn't write table snapshot for %s: %s", f_path, e)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        # Removes snapshots of vanished or changed files and snapshots that haven't been used for a while
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        now = time.time()
+        for name in names:
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime > self.max_age:
+                    raise ValueError('Snapshot too old')
+                with open(path, 'rb') as file:
+                    version, source, file_id, content_hash = self._read_header(file)
+                if version != self.version or tuple(file_id) != self.file_id(source):
+                    raise ValueError('Stale snapshot')
+            except (OSError, EOFError, ValueError, TypeError):
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
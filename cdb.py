@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os
+import struct
+
+__all__ = ['CdbWriter', 'CdbReader', 'CdbError', 'cdb_hash']
+
+# Layout (all numbers are unsigned 32 bit little endian):
+#   256 (position, slot count) pairs pointing to the hash tables
+#   records: key length, value length, key, value
+#   256 hash tables of (hash, record position) slots with twice as many slots as records
+HEADER_SIZE = 256 * 8
+MAX_SIZE = 0xffffffff
+
+
+class CdbError(Exception):
+    pass
+
+
+def cdb_hash(data):
+    h = 5381
+    for c in data:
+        h = (((h << 5) + h) ^ c) & 0xffffffff
+    return h
+
+
+class CdbWriter(object):
+    # Writes to a temporary file which replaces path when the writer is closed
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        self._file = open(self._tmp_path, 'wb')
+        self._file.seek(HEADER_SIZE)
+        self._pos = HEADER_SIZE
+        self._tables = [[] for _ in range(256)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, key, value):
+        if isinstance(key, str):
+            key = key.encode()
+        if isinstance(value, str):
+            value = value.encode()
+        h = cdb_hash(key)
+        self._tables[h & 255].append((h, self._pos))
+        self._file.write(struct.pack('<LL', len(key), len(value)))
+        self._file.write(key)
+        self._file.write(value)
+        self._advance(8 + len(key) + len(value))
+
+    def _advance(self, size):
+        self._pos += size
+        if self._pos > MAX_SIZE:
+            self.abort()
+            raise CdbError('%s would exceed the maximum size of a cdb file.' % self.path)
+
+    def close(self):
+        header = []
+        for entries in self._tables:
+            count = len(entries) * 2
+            slots = [(0, 0)] * count
+            for h, pos in entries:
+                i = (h >> 8) % count
+                # Record positions are never 0, so they mark the used slots
+                while slots[i][1]:
+                    i = (i + 1) % count
+                slots[i] = (h, pos)
+            header.append((self._pos, count))
+            self._file.write(b''.join(struct.pack('<LL', h, pos) for h, pos in slots))
+            self._advance(8 * count)
+        self._file.seek(0)
+        self._file.write(b''.join(struct.pack('<LL', pos, count) for pos, count in header))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class CdbReader(object):
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._data = file.read()
+
+    def get(self, key, default=None):
+        if isinstance(key, str):
+            key = key.encode()
+        h = cdb_hash(key)
+        pos, count = struct.unpack_from('<LL', self._data, (h & 255) * 8)
+        if not count:
+            return default
+        i = (h >> 8) % count
+        for _ in range(count):
+            slot_hash, record = struct.unpack_from('<LL', self._data, pos + i * 8)
+            if not record:
+                return default
+            if slot_hash == h:
+                key_len, value_len = struct.unpack_from('<LL', self._data, record)
+                start = record + 8
+                if self._data[start:start + key_len] == key:
+                    return self._data[start + key_len:start + key_len + value_len].decode()
+            i = (i + 1) % count
+        return default
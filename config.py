@@ -1,11 +1,8 @@
 #!/usr/bin/env python3
 import os
-import logging
 import collections
 from abc import ABC
 
-import yaml
-
 __all__ = ['Config', 'FileConfig', 'ConfigException']
 
 
@@ -13,12 +10,18 @@ class ConfigException(Exception):
     pass
 
 
+def _load_yaml(stream):
+    # yaml is only imported when a config is loaded, the C loader is used if PyYAML was built with libyaml
+    import yaml
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
 class Config(collections.UserDict):
     def __init__(self, config=None, filename=None):
         super().__init__()
         self.filename = filename
         if config is not None:
-            self.data = yaml.load(config, Loader=yaml.SafeLoader)
+            self.data = _load_yaml(config)
         elif filename is not None:
             try:
                 self.data = self._load(filename)
@@ -30,10 +33,11 @@ class Config(collections.UserDict):
     @staticmethod
     def _load(filename):
         with open(filename) as f:
-            d = yaml.load(f, Loader=yaml.SafeLoader)
+            d = _load_yaml(f)
         return d
 
     def dump(self):
+        import yaml
         return yaml.dump(self.data, default_flow_style=False, indent=4)
 
 
@@ -52,6 +56,10 @@ class FileConfig(collections.abc.Mapping):
     def __getitem__(self, key):
         return self._pathes[key]
 
+    @property
+    def config(self):
+        return self._config
+
     def _set(self, name, path, file=None):
         if file is None:
             self._pathes[name] = os.path.expanduser(path)
@@ -59,6 +67,8 @@ class FileConfig(collections.abc.Mapping):
             self._pathes[name] = os.path.join(os.path.expanduser(path), file)
 
     def _init_pathes(self):
+        # logging is imported here since it's slow to import and only needed for incomplete configs
+        import logging
         filesystem = self._config.get('filesystem')
         if filesystem is None:
             logging.warning("No filesystem entry in config %s" % self._config.filename)
@@ -85,6 +95,7 @@ class FileConfig(collections.abc.Mapping):
                     logging.info("Path for '%s' not found in configfile '%s'", name, self._config.filename)
 
     def _get_path(self, fscfg, name):
+        import logging
         pathmap = fscfg.get('file-path-map')
         pathes = fscfg.get('pathes')
         if pathes is None:
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import types
+import socket
+import logging
+import argparse
+import threading
+import contextlib
+import socketserver
+
+import postfixhelper
+
+__all__ = ['Daemon', 'DaemonApp', 'DaemonError', 'request', 'request_from_args']
+
+DEFAULT_DELAY = 1.0
+DEFAULT_MAX_DELAY = 10.0
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonApp(postfixhelper.App):
+    # Applies changes in memory and leaves saving to the daemon
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def _save_alias_tables(self, args):
+        if not args.save:
+            return self.list_aliases(args)
+        self.daemon.schedule_save()
+        return 'Changes applied, the tables will be saved shortly.'
+
+    @staticmethod
+    def _open_input(args):
+        # The client sends the lines of the input file along with the request
+        return contextlib.nullcontext(args.lines)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # One JSON object per line in both directions, the connection may be reused for more requests
+    def handle(self):
+        for line in self.rfile:
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                response = {'ok': False, 'error': 'Invalid request: %s' % e}
+            else:
+                response = self.server.daemon.handle(data)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    actions = ('list_aliases', 'add_alias', 'delete_alias', 'delete_alias_user', 'batch_aliases',
+               'resolve_aliases', 'check', 'export_tables', 'import_tables', 'diff_tables', 'apply_patch')
+    # Without save these only preview their changes, which are undone once the result is ready
+    changing_actions = ('add_alias', 'delete_alias', 'delete_alias_user', 'batch_aliases', 'import_tables',
+                        'apply_patch')
+
+    def __init__(self, path, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY, socketmap=None):
+        self.path = path
+        # Address for the socketmap lookup server, see lookup.SocketmapServer.start
+        self.socketmap = socketmap
+        self._lookup_server = None
+        self.delay = delay
+        self.max_delay = max_delay
+        self.app = DaemonApp(self)
+        # Guards the tables, requests and saves are handled one at a time
+        self.lock = threading.RLock()
+        self._timer = None
+        self._first_change = None
+        # Error of the last save if it failed, reported with every response until a save succeeds
+        self._save_error = None
+        self._server = None
+
+    def handle(self, data):
+        action = data.get('action') if isinstance(data, dict) else None
+        if action not in self.actions:
+            return {'ok': False, 'error': "Unknown action '%s'." % action}
+        with self.lock:
+            tables = []
+            try:
+                args = argparse.Namespace(**data.get('args', {}))
+                if action in self.changing_actions and not getattr(args, 'save', False):
+                    tables = [self.app._table(name) for name in postfixhelper.TABLE_NAMES]
+                    for table in tables:
+                        table.begin()
+                result = getattr(self.app, action)(args)
+                if isinstance(result, types.GeneratorType):
+                    result = '\n'.join(result)
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            else:
+                response = {'ok': True, 'result': result}
+            finally:
+                for table in tables:
+                    table.rollback()
+            if self._save_error is not None:
+                response['save_error'] = self._save_error
+        return response
+
+    def schedule_save(self):
+        # Every change postpones the save by delay, but not beyond max_delay after the first unsaved change
+        with self.lock:
+            now = time.monotonic()
+            if self._first_change is None:
+                self._first_change = now
+            self._start_timer(max(0.0, min(self.delay, self.max_delay - (now - self._first_change))))
+
+    def _start_timer(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self, retry=True):
+        # A failed save stays scheduled and is tried again after max_delay
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            try:
+                result = self.app.save_alias_tables()
+            except Exception as e:
+                logging.error('Saving the tables failed: %s', e)
+                self._save_error = 'Saving the tables failed: %s' % e
+                if retry:
+                    self._start_timer(self.max_delay)
+                return None
+            self._first_change = None
+            self._save_error = None
+            logging.info(result)
+            return result
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = Server(self.path, RequestHandler)
+        self._server.daemon = self
+        if self.socketmap:
+            import lookup
+            # Lookups wait while requests and saves change the tables
+            self._lookup_server = lookup.SocketmapServer(lock=self.lock)
+            # Parse the tables before the first lookup arrives
+            for table in self._lookup_server.tables.values():
+                len(table)
+            self._lookup_server.start_thread(self.socketmap)
+        try:
+            self._server.serve_forever()
+        finally:
+            if self._lookup_server is not None:
+                self._lookup_server.stop()
+            self._server.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            if self._first_change is not None:
+                self.flush(retry=False)
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def request(path, action, args):
+    # Sends one request to the daemon listening on path and returns its result
+    data = {'action': action, 'args': args}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError as e:
+            raise DaemonError("Couldn't connect to %s: %s" % (path, e)) from e
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps(data).encode() + b'\n')
+            stream.flush()
+            line = stream.readline()
+    if not line:
+        raise DaemonError('No response from %s.' % path)
+    response = json.loads(line)
+    if response.get('save_error'):
+        print(response['save_error'], file=sys.stderr)
+    if not response.get('ok'):
+        raise DaemonError(response.get('error'))
+    return response.get('result')
+
+
+def request_from_args(path, args):
+    data = vars(args).copy()
+    if args.action in ('batch_aliases', 'resolve_aliases', 'import_tables', 'apply_patch'):
+        if args.file == '-':
+            data['lines'] = sys.stdin.readlines()
+        else:
+            with open(args.file) as file:
+                data['lines'] = file.readlines()
+    return request(path, args.action, data)
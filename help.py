@@ -1,3 +1,15 @@
+# Number of configs --multi-config works on at once, also the default of session.run_multi
+DEFAULT_JOBS = 4
+
+
+def non_negative_int(text):
+    value = int(text)
+    if value < 0:
+        import argparse
+        raise argparse.ArgumentTypeError("%s isn't 0 or more." % text)
+    return value
+
+
 class Help(object):
     save_option = {
         'name': '--save',
@@ -60,6 +72,41 @@ class Help(object):
                             'help': 'Prints the files as written.',
                             'action': 'store_true',
                         },
+                        {
+                            'name': '--domain',
+                            'dest': 'filter_domain',
+                            'metavar': 'DOMAIN',
+                            'help': 'Only aliases in this domain.',
+                        },
+                        {
+                            'name': '--user',
+                            'dest': 'filter_user',
+                            'metavar': 'USER',
+                            'help': 'Only aliases delivering to or sending as this user.',
+                        },
+                        {
+                            'name': '--prefix',
+                            'dest': 'filter_prefix',
+                            'metavar': 'PREFIX',
+                            'help': 'Only aliases starting with this prefix.',
+                        },
+                        {
+                            'name': '--limit',
+                            'help': 'Print at most this many aliases.',
+                            'type': non_negative_int,
+                        },
+                        {
+                            'name': '--offset',
+                            'help': 'Skip this many aliases.',
+                            'type': non_negative_int,
+                            'default': 0,
+                        },
+                        {
+                            'name': '--stream',
+                            'help': 'Print every alias as soon as it is found, sorted by alias and with fixed '
+                                    'column widths.',
+                            'action': 'store_true',
+                        },
                     ],
                     'defaults': {'action': 'list_aliases'}
                 },
@@ -82,6 +129,51 @@ class Help(object):
                     ],
                     'defaults': {'action': 'add_alias'}
                 },
+                {
+                    'name': 'batch',
+                    'help': 'Applies many alias operations at once and saves the tables only once. Reads one '
+                            'operation per line, either JSON ({"op": "add", "alias": ..., "user": ..., '
+                            '"comment": ...}) or plain words (add ALIAS USER [COMMENT], del ALIAS, deluser USER).',
+                    'options': [
+                        save_option,
+                        {
+                            'name': '--strict',
+                            'help': "Don't save anything if one of the operations fails.",
+                            'action': 'store_true',
+                        },
+                    ],
+                    'arguments': [
+                        {
+                            'name': 'file',
+                            'help': "File with the operations, '-' reads from stdin.",
+                            'nargs': '?',
+                            'default': '-',
+                        }
+                    ],
+                    'defaults': {'action': 'batch_aliases'}
+                },
+                {
+                    'name': 'resolve',
+                    'help': 'Resolves addresses like Postfix does and prints each address with the final '
+                            'recipients from virtual-alias and the allowed senders from sender-login-maps, '
+                            'separated by tabs.',
+                    'options': [
+                        {
+                            'name': '--json',
+                            'help': 'Print one JSON object per address.',
+                            'action': 'store_true',
+                        },
+                    ],
+                    'arguments': [
+                        {
+                            'name': 'file',
+                            'help': "File with one address per line, '-' reads from stdin.",
+                            'nargs': '?',
+                            'default': '-',
+                        }
+                    ],
+                    'defaults': {'action': 'resolve_aliases'}
+                },
             ]
         },
         {
@@ -113,17 +205,178 @@ class Help(object):
             'commands': []
         },
     ]
+    serve = {
+        'name': 'serve',
+        'help': 'Runs a daemon which keeps the tables in memory and accepts the alias commands on a Unix socket. '
+                'Use --socket with the other commands to send them to it.',
+        'options': [
+            {
+                'name': '--listen',
+                'help': 'Path of the Unix socket to listen on.',
+                'default': '/run/postfix-helper.sock',
+            },
+            {
+                'name': '--delay',
+                'help': 'Seconds without changes after which the tables get saved.',
+                'type': float,
+                'default': 1.0,
+            },
+            {
+                'name': '--max-delay',
+                'help': 'Seconds after which changes get saved even if more changes keep coming in.',
+                'type': float,
+                'default': 10.0,
+            },
+            {
+                'name': '--socketmap',
+                'help': 'Also answer Postfix socketmap lookups from memory on this address (unix:/path or '
+                        'inet:host:port). The map names are the table names, e.g. '
+                        'socketmap:unix:/path:virtual-alias.',
+            },
+        ],
+        'defaults': {'action': 'serve'}
+    }
+    check = {
+        'name': 'check',
+        'help': 'Checks the tables for duplicate keys, aliases pointing to missing users, sender-login-maps '
+                'entries without alias and alias loops. Prints kind, table, key and details separated by tabs.',
+        'options': [
+            {
+                'name': '--no-duplicates',
+                'help': "Don't read the table files again to look for duplicate keys.",
+                'action': 'store_true',
+            },
+        ],
+        'defaults': {'action': 'check'}
+    }
+    table_option = {
+        'name': '--table',
+        'help': 'Only this table, can be given more than once. Default are all tables.',
+        'action': 'append',
+        'choices': ['virtual-alias', 'sender-login-maps', 'virtual-mailbox-users', 'virtual-mailbox-domains'],
+    }
+    format_option = {
+        'name': '--format',
+        'help': 'ndjson (default) or csv.',
+        'choices': ['ndjson', 'csv'],
+        'default': 'ndjson',
+    }
+    export = {
+        'name': 'export',
+        'help': 'Prints all entries of the tables as they are in memory, sorted by key, with table, kind (entry, '
+                'header or footer), key, value, deleted flag and comment lines, one per line.',
+        'options': [
+            table_option,
+            format_option,
+        ],
+        'defaults': {'action': 'export_tables'}
+    }
+    import_ = {
+        'name': 'import',
+        'help': "Merges entries in the format written by 'export' into the tables. The rows of a table have to "
+                "follow each other, sorted by key. Entries are taken as they are, without checking for users or "
+                "domains.",
+        'arguments': [
+            {
+                'name': 'file',
+                'help': "File to read, '-' for stdin.",
+                'nargs': '?',
+                'default': '-',
+            },
+        ],
+        'options': [
+            table_option,
+            format_option,
+            {
+                'name': '--replace',
+                'help': 'Remove entries missing from the input from the tables it contains.',
+                'action': 'store_true',
+            },
+            save_option,
+        ],
+        'defaults': {'action': 'import_tables'}
+    }
+    diff = {
+        'name': 'diff',
+        'help': "Prints the changes from old to new as patch for 'apply-patch', one JSON object per line.",
+        'arguments': [
+            {
+                'name': 'old',
+                'help': 'Old version of the table given with --table, or a directory with old versions of the '
+                        'tables named like the configured files.',
+            },
+            {
+                'name': 'new',
+                'help': 'New version, a file or directory like old. Default are the current tables.',
+                'nargs': '?',
+            },
+        ],
+        'options': [
+            table_option,
+        ],
+        'defaults': {'action': 'diff_tables'}
+    }
+    apply_patch = {
+        'name': 'apply-patch',
+        'help': "Applies a patch written by 'diff' to the tables. With --save only the changes are fed to postmap, "
+                "as long as they stay below 'postmap-incremental-threshold'.",
+        'arguments': [
+            {
+                'name': 'file',
+                'help': "File to read, '-' for stdin.",
+                'nargs': '?',
+                'default': '-',
+            },
+        ],
+        'options': [
+            save_option,
+        ],
+        'defaults': {'action': 'apply_patch'}
+    }
     main = {
         'name': 'objects',
         'help': 'object to show or edit.',
         'commands-title': 'Objects',
         'commands-help': 'Object to edit',
-        'commands': objects,
+        'commands': objects + [check, export, import_, diff, apply_patch, serve],
         'options': [
             {
                 'name': '--config-file',
                 'help': 'Use this config instead default.'
-            }
+            },
+            {
+                'name': '--multi-config',
+                'metavar': 'GLOB',
+                'help': 'Run the command for every config file matching GLOB, each with its own tables. Can be '
+                        'given more than once.',
+                'action': 'append',
+            },
+            {
+                'name': '--jobs',
+                'help': 'Number of configs --multi-config works on at once.',
+                'type': int,
+                'default': DEFAULT_JOBS,
+            },
+            {
+                'name': '--no-cache',
+                'help': "Parse the tables instead of using the snapshots in 'cache-dir'.",
+                'action': 'store_true',
+            },
+            {
+                'name': '--socket',
+                'help': "Send the command to the daemon started with 'serve' listening on this socket.",
+            },
+            {
+                'name': '--timings',
+                'help': 'Print the time and peak memory of loading, parsing, serializing, writing and postmap as '
+                        'JSON to stderr.',
+                'action': 'store_true',
+            },
+            {
+                'name': '--profile',
+                'metavar': 'FILE',
+                'help': 'Like --timings, and write cProfile statistics of the run to FILE.',
+            },
         ]
     }
 
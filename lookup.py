@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import os
+import asyncio
+import logging
+import contextlib
+import threading
+
+import postfixhelper
+
+__all__ = ['SocketmapServer', 'netstring', 'TABLES']
+
+# Tables served by default, their names are the map names in socketmap:unix:/path:name
+TABLES = ('virtual-alias', 'sender-login-maps', 'virtual-mailbox-users', 'virtual-mailbox-domains')
+
+MAX_REQUEST = 100000
+MAX_REPLY = 100000
+
+
+def netstring(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return b'%d:%s,' % (len(data), data)
+
+
+class SocketmapServer(object):
+    # Answers lookups with Postfix' socketmap protocol straight from the in-memory tables. Requests are
+    # netstrings with '<name> <key>', replies are 'OK <value>', 'NOTFOUND ', 'TEMP <reason>' or
+    # 'PERM <reason>'. Changes to the tables are visible to the next lookup. With a lock, lookups wait for
+    # whoever changes or reloads the tables holding it, so they never see a table half loaded.
+    def __init__(self, tables=None, lock=None):
+        if tables is None:
+            tables = {name: postfixhelper.PostfixTable(name) for name in TABLES}
+        self.tables = tables
+        self.lock = lock if lock is not None else contextlib.nullcontext()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._path = None
+
+    def lookup(self, request):
+        name, _, key = request.partition(' ')
+        table = self.tables.get(name)
+        if table is None:
+            return 'PERM Unknown map %s' % name
+        try:
+            with self.lock:
+                value = table.lookup(key)
+        except Exception as e:
+            logging.error('Lookup of %s in %s failed: %s', key, name, e)
+            return 'TEMP Lookup failed'
+        if value is None:
+            return 'NOTFOUND '
+        reply = 'OK ' + value
+        if len(reply.encode()) > MAX_REPLY:
+            return 'PERM Reply too long'
+        return reply
+
+    async def _read_request(self, reader):
+        length = await reader.readuntil(b':')
+        if not length[:-1].isdigit() or len(length) > 11 or int(length[:-1]) > MAX_REQUEST:
+            raise ValueError('Invalid netstring length %r' % length)
+        data = await reader.readexactly(int(length[:-1]) + 1)
+        if data[-1:] != b',':
+            raise ValueError('Netstring not terminated')
+        return data[:-1].decode()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (ValueError, asyncio.LimitOverrunError, UnicodeDecodeError) as e:
+                    logging.warning('Invalid socketmap request: %s', e)
+                    break
+                writer.write(netstring(self.lookup(request)))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, address):
+        # address is unix:/path, inet:host:port or just a path
+        self._loop = asyncio.get_running_loop()
+        if address.startswith('inet:'):
+            host, _, port = address[5:].rpartition(':')
+            self._server = await asyncio.start_server(self._handle, host or None, int(port))
+        else:
+            path = address[5:] if address.startswith('unix:') else address
+            if os.path.exists(path):
+                os.remove(path)
+            self._server = await asyncio.start_unix_server(self._handle, path)
+            self._path = path
+        return self._server
+
+    def start_thread(self, address):
+        # Runs the server in a background thread and returns once it's listening
+        started = threading.Event()
+        errors = []
+
+        async def run():
+            try:
+                server = await self.start(address)
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                started.set()
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+        self._thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            self._thread.join()
+            self._thread = None
+            raise errors[0]
+
+    def stop(self):
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
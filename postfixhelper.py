@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
+import io
+import itertools
+import json
 import re
 import math
+import array
+import bisect
+import mmap
 import sys
+import types
 import argparse
 import os
-import shutil
 import collections
-import subprocess
+import contextlib
+import _thread
 
 if os.path.islink(__file__):
     sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 import config
 import help
+import timings
 
 try:
     del FILE_CONFIG
@@ -24,6 +32,8 @@ except:
     pass
 
 DEFAULT_POSTMAP = 'postmap'
+DEFAULT_MAP_WRITER = 'postmap'
+DEFAULT_INCREMENTAL_THRESHOLD = 0.1
 CONFIG_FILE = 'config.yaml'
 CONFIG = None
 FILE_CONFIG = None
@@ -50,9 +60,12 @@ def load_config(config_file=None):
 
 def load_file_config(config_file=None):
     global FILE_CONFIG, CONFIG_FILE, CONFIG
-    CONFIG = load_config(config_file)
     if FILE_CONFIG is None:
-        FILE_CONFIG = config.FileConfig(CONFIG)
+        with timings.TIMINGS.phase('load_file_config'):
+            CONFIG = load_config(config_file)
+            FILE_CONFIG = config.FileConfig(CONFIG)
+    else:
+        CONFIG = load_config(config_file)
     return FILE_CONFIG
 
 
@@ -60,64 +73,136 @@ class ParserError(Exception):
     pass
 
 
+TableRecord = collections.namedtuple('TableRecord', 'kind key value comment line_no')
+
+
+class LazyComment(object):
+    # Comment lines as they are in the file. They are only stripped of '#' and blanks when the comment of
+    # an entry is used, most commands never look at comments.
+    __slots__ = ('lines',)
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def materialize(self):
+        return [line.partition('#')[2].strip() for line in self.lines]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyComment):
+            other = other.materialize()
+        return isinstance(other, (list, tuple)) and self.materialize() == list(other)
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+
+LazyComment.EMPTY = LazyComment(())
+
+
 class PostfixTableParser(object):
     singleton_instance = None
 
     lines = [
-        ('ENTRY', r'^(?P<K>[^#\s]\S+)(?P<MULTI>([ \t]*\n+)*)[ \t]+(?P<V>\S+)[ \t]*$'),
+        ('ENTRY', r'^(?P<K>[^#\s]\S+)[ \t]+(?P<V>\S+)[ \t]*$'),
+        ('KEY', r'^(?P<SK>[^#\s]\S+)[ \t]*$'),
+        ('VALUE', r'^[ \t]+(?P<SV>\S+)[ \t]*$'),
         ('DELETED', r'^[ \t]*#--[ \t]+(?P<DK>\S+)[ \t]+(?P<DV>\S+)[ \t]*$'),
-        ('SYS_COMMENT', r'^[ \t]*#==([^\n]*)$'),
-        ('COMMENT', r'^[ \t]*#(?P<C>.*)[^\n]*$'),
+        ('SYS_COMMENT', r'^[ \t]*#==(.*)$'),
+        ('COMMENT', r'^[ \t]*#(?P<C>.*)$'),
         ('EMPTY', r'^[ \t]*$'),
         ('ERROR', r'^.+$')
     ]
     line_expr = '|'.join("(?P<%s>%s)" % token for token in lines)
-    line_re = re.compile(line_expr, re.MULTILINE)
+    line_re = re.compile(line_expr)
 
     def __new__(cls, *args, **kwargs):
         if PostfixTableParser.singleton_instance is None:
             PostfixTableParser.singleton_instance = super().__new__(cls, *args, **kwargs)
         return cls.singleton_instance
 
-    def parse(self,  data, table=None):
-        if table is None:
-            table = {}
+    @staticmethod
+    def _split_lines(lines):
+        # A trailing newline (or no data at all) leaves an empty last line behind.
+        last = None
+        for last in lines:
+            yield last.rstrip('\n')
+        if last is None or last.endswith('\n'):
+            yield ''
+
+    # Yields TableRecords from a string, an open file or any other iterable of lines as soon as
+    # they are complete, so the source never has to be held in memory as a whole. Comments are
+    # LazyComments of the raw lines, with comments=False they are left out.
+    def iter_parse(self, lines, comments=True):
+        if isinstance(lines, str):
+            lines = io.StringIO(lines)
+        started = False
+        pending = None
         comment = []
         line = 0
-        for match in self.line_re.finditer(data):
+        # Every distinct value is held once per parse, many aliases share their target
+        values = {}
+        for text in self._split_lines(lines):
             line += 1
+            # Plain comments are the most common lines starting with '#', they don't need the expression
+            if text[:1] == '#' and text[1:3] not in ('--', '==') and pending is None:
+                if comments:
+                    comment.append(text)
+                continue
+            match = self.line_re.match(text)
             kind = match.lastgroup
-            values = match.groupdict()
+            if pending is not None:
+                if kind == 'EMPTY':
+                    continue
+                if kind != 'VALUE':
+                    raise ParserError("Syntax error in line '%s'" % pending[1])
+                kind = 'ENTRY'
+                key, value = pending[0], match.group('SV')
+                pending = None
+            elif kind == 'ENTRY':
+                key, value = match.group('K', 'V')
             if kind == 'ENTRY':
-                key = values['K']
-                value = values['V']
-                multiline = values.get('MULTI')
-                if multiline is not None:
-                    line += multiline.count('\n')
-                if table:
-                    table[key] = TableEntry(value, comment.copy(), line)
-                else:
-                    table[key] = TableEntry(value, [], line)
+                yield TableRecord('ENTRY', sys.intern(key), values.setdefault(value, value),
+                                  LazyComment(comment) if started and comment else LazyComment.EMPTY, line)
+                started = True
                 comment = []
+            elif kind == 'KEY':
+                pending = (match.group('SK'), text)
             elif kind == 'DELETED':
-                key = values['DK']
-                value = values['DV']
-                if table:
-                    table[key] = TableEntry(value, comment.copy(), line, True)
+                if started:
+                    value = match.group('DV')
+                    yield TableRecord('DELETED', sys.intern(match.group('DK')), values.setdefault(value, value),
+                                      LazyComment(comment.copy()) if comment else LazyComment.EMPTY, line)
             elif kind == 'COMMENT':
-                comment.append(values['C'].strip())
+                if comments:
+                    comment.append(text)
             elif kind == 'EMPTY':
-                if not table:
-                    table['#'] = TableEntry(None, comment.copy(), 0)
+                if not started:
+                    yield TableRecord('HEADER', '#', None,
+                                      LazyComment(comment) if comment else LazyComment.EMPTY, 0)
+                    started = True
                     comment = []
             elif kind == 'SYS_COMMENT':
                 pass
-            elif kind == 'ERROR':
-                raise ParserError("Syntax error in line '%s'" % (match.group()))
+            elif kind in ('ERROR', 'VALUE'):
+                raise ParserError("Syntax error in line '%s'" % text)
             else:
-                raise ParserError("Parser error: Unkown kind '%s' in match '%s'" % (kind, match.group()))
+                raise ParserError("Parser error: Unkown kind '%s' in match '%s'" % (kind, text))
+        if pending is not None:
+            raise ParserError("Syntax error in line '%s'" % pending[1])
         if comment:
-            table[None] = TableEntry(None, comment, line)
+            yield TableRecord('FOOTER', None, None, LazyComment(comment), line)
+
+    def parse(self, data, table=None, comments=True):
+        if table is None:
+            table = {}
+        for record in self.iter_parse(data, comments):
+            table[record.key] = TableEntry.from_record(record)
         return table
 
 
@@ -135,20 +220,25 @@ class PFTableSerializer(object):
             out.append('# ' + c)
         if comments:
             out.append('')
-        if not original_order:
-            entries = PFTableSerializer._sort_by_line_no(data)
-            entries.sort(key=lambda v: v['entry'].value if v['entry'].value else '')
+        if not original_order and hasattr(data, 'sorted_entries'):
+            # PostfixTables keep their entries sorted by value and know the width of the keys
+            entries = data.sorted_entries()
+            max_len = data.key_width()
         else:
             entries = PFTableSerializer._sort_by_line_no(data)
-        max_len = 0
-        for e in entries:
-            key = '#-- ' + e['key'] if e['entry'].deleted else e['key']
-            max_len = max(len(key), max_len)
+            if not original_order:
+                entries.sort(key=lambda v: v['entry'].value if v['entry'].value else '')
+            entries = [(e['key'], e['entry']) for e in entries]
+            max_len = 0
+            for key, entry in entries:
+                if key is None:
+                    continue
+                key = '#-- ' + key if entry.deleted else key
+                max_len = max(len(key), max_len)
         min_spaces = round(8 + (1-(max_len/8 - math.floor(max_len/8))) * 8)
         old_entry = ''
-        for e in entries:
-            entry = e['entry']
-            key = '#-- ' + e['key'] if e['entry'].deleted else e['key']
+        for key, entry in entries:
+            key = '#-- ' + key if entry.deleted else key
             if key is not None and key != '#':
                 if print_system_comments and not original_order and old_entry != entry.value:
                     old_entry = entry.value
@@ -168,6 +258,101 @@ class PFTableSerializer(object):
         return '\n'.join(out)
 
 
+class MappedTable(collections.abc.MutableMapping):
+    # Whole-file expressions over the raw bytes. Only keys get decoded while scanning; values and
+    # comments are decoded from their byte ranges when an entry is accessed for the first time.
+    lines = [
+        ('ENTRY', rb'^(?P<K>[^#\s]\S+)(?P<MULTI>(?:[ \t]*\n+)*)[ \t]+\S+[ \t]*$'),
+        ('DELETED', rb'^[ \t]*#--[ \t]+(?P<DK>\S+)[ \t]+\S+[ \t]*$'),
+        ('SYS_COMMENT', rb'^[ \t]*#==[^\n]*$'),
+        ('COMMENT', rb'^[ \t]*#[^\n]*$'),
+        ('EMPTY', rb'^[ \t]*$'),
+        ('ERROR', rb'^.+$')
+    ]
+    line_expr = b'|'.join(b"(?P<%s>%s)" % (name.encode(), expr) for name, expr in lines)
+    line_re = re.compile(line_expr, re.MULTILINE)
+
+    def __init__(self, f_path):
+        self.file = f_path
+        with open(f_path, 'rb') as file:
+            try:
+                self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                self._data = b''
+        # key -> (comment start, entry start, entry end, line no., deleted) or the decoded TableEntry
+        self._index = {}
+        self._scan()
+
+    def _scan(self):
+        index = self._index
+        started = False
+        has_comment = False
+        block_start = 0
+        line = 0
+        for match in self.line_re.finditer(self._data):
+            line += 1
+            kind = match.lastgroup
+            if kind == 'ENTRY':
+                line += match.group('MULTI').count(b'\n')
+                start = block_start if started else match.start()
+                index[sys.intern(match.group('K').decode())] = (start, match.start(), match.end(), line, False)
+                started = True
+                has_comment = False
+                block_start = match.end()
+            elif kind == 'DELETED':
+                if started:
+                    key = sys.intern(match.group('DK').decode())
+                    index[key] = (block_start, match.start(), match.end(), line, True)
+            elif kind == 'COMMENT':
+                has_comment = True
+            elif kind == 'EMPTY':
+                if not started:
+                    index['#'] = (block_start, match.start(), match.start(), 0, False)
+                    started = True
+                    has_comment = False
+                    block_start = match.end()
+            elif kind == 'ERROR':
+                raise ParserError("Syntax error in line '%s'" % match.group().decode())
+        if has_comment:
+            index[None] = (block_start, len(self._data), len(self._data), line, False)
+
+    def _decode(self, key, location):
+        comment_start, start, end, line_no, deleted = location
+        comment = []
+        for text in self._data[comment_start:start].decode().split('\n'):
+            match = PostfixTableParser.line_re.match(text)
+            if match.lastgroup == 'COMMENT':
+                comment.append(text)
+        comment = LazyComment(comment)
+        value = None
+        if key is not None and key != '#':
+            value = self._data[start:end].decode().split()[-1]
+        return TableEntry(value, comment, line_no, deleted)
+
+    def __getitem__(self, key):
+        entry = self._index[key]
+        if isinstance(entry, tuple):
+            entry = self._decode(key, entry)
+            self._index[key] = entry
+        return entry
+
+    def __setitem__(self, key, value):
+        self._index[key] = value
+
+    def __delitem__(self, key):
+        del self._index[key]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
 class FactoryError(Exception):
     pass
 
@@ -176,27 +361,113 @@ class ConfigError(Exception):
     pass
 
 
+class ConflictError(Exception):
+    pass
+
+
+def file_stat(path):
+    # Identifies the version of a file, None if it doesn't exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+# Lock files held by each thread as (thread id, path), flock would block on a second lock of the same file
+_HELD_LOCKS = set()
+
+
+@contextlib.contextmanager
+def lock_file(path, exclusive=False):
+    # flock on a sidecar file, the table itself gets replaced when it is written. Writers create it, readers
+    # only lock it if it exists, so they don't need write access to the directory.
+    import fcntl
+    lock_path = os.path.abspath(path + '.lock')
+    held = (_thread.get_ident(), lock_path)
+    if held in _HELD_LOCKS:
+        yield
+        return
+    try:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT if exclusive else os.O_RDONLY, 0o644)
+    except FileNotFoundError:
+        if exclusive:
+            raise
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        _HELD_LOCKS.add(held)
+        yield
+    finally:
+        _HELD_LOCKS.discard(held)
+        os.close(fd)
+
+
+def write_file(path, data):
+    # Writes to a temporary file next to path and renames it, readers see either the old or the new file.
+    # A symlink is kept and the file it points to replaced, with the mode and, as root, the owner of the old file.
+    import tempfile
+    import shutil
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+            if os.geteuid() == 0:
+                stat = os.stat(path)
+                os.chown(tmp_path, stat.st_uid, stat.st_gid)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 class Table(collections.abc.MutableMapping):
     parser = None
     files_dict_getter = None
     serializer = None
+    config_getter = None
     table_singleton = True
+    backend = 'dict'
+    # Backends holding fully parsed tables; 'mmap' is handled separately
+    mappings = {'dict': dict, 'columnar': lambda: ColumnarTable()}
+    use_cache = True
+    # file_stat of the file when it was loaded
+    _file_stat = None
+    # Tables created with a FileConfig of their own aren't singletons and don't use the global config
+    file_config = None
+    # Read-only commands skip comments when parsing, such tables can't be serialized
+    load_comments = True
+    _without_comments = False
 
     def __new__(cls, *args, **kwargs):
-        if cls.table_singleton:
+        if cls.table_singleton and kwargs.get('file_config') is None:
             f_path = args[0]
             attr_name = '_instances'
             if not hasattr(cls, attr_name):
                 setattr(cls, attr_name, {})
             obj = cls._instances.get(f_path)
-            if not obj:
+            if obj is None:
                 obj = super().__new__(cls)
                 cls._instances[f_path] = obj
             return obj
         return super().__new__(cls)
 
-    def __init__(self, file):
+    def __init__(self, file, backend=None, file_config=None):
         self.file = file
+        if backend is not None:
+            self.backend = backend
+        if file_config is not None:
+            self.file_config = file_config
         super().__init__()
 
     def __getitem__(self, item):
@@ -220,21 +491,110 @@ class Table(collections.abc.MutableMapping):
             return self._mapping
         raise AttributeError()
 
+    def _get_config(self):
+        if self.file_config is not None:
+            return self.file_config.config
+        if self.__class__.config_getter is None:
+            return None
+        return self.__class__.config_getter()
+
+    def _get_files(self):
+        if self.file_config is not None:
+            return self.file_config
+        return self.__class__.files_dict_getter()
+
+    def _get_backend(self):
+        cfg = self._get_config() if 'backend' not in self.__dict__ else None
+        if cfg is not None:
+            return cfg.get('table-backend', self.backend)
+        return self.backend
+
     def _initialize(self):
-        self._parse_file(self.file)
+        backend = self._get_backend()
+        if backend == 'mmap':
+            self._map_file(self.file)
+        elif backend in self.mappings:
+            self._parse_file(self.file)
+        else:
+            raise ConfigError("Unknown table backend '%s'." % backend)
 
-    def _parse_file(self, filename):
-        self._mapping = {}
-        f_path = self.__class__.files_dict_getter().get(filename)
+    def _get_path(self, filename):
+        f_path = self._get_files().get(filename)
         if f_path is None:
             raise FactoryError("No Configuration entry for file %s" % filename)
+        return f_path
+
+    def records(self, filename=None, comments=True):
+        if filename is None:
+            filename = self.file
+        f_path = self._get_path(filename)
         with open(f_path, 'r') as file:
             try:
-                self.parser().parse(file.read(), self._mapping)
+                yield from self.parser().iter_parse(file, comments)
             except ParserError as e:
                 raise FactoryError("Error while parsing %s under %s" % (filename, f_path)) from e
 
+    def _get_cache(self):
+        cfg = self._get_config() if self.use_cache else None
+        if cfg is None:
+            return None
+        directory = cfg.get('cache-dir')
+        if not directory:
+            return None
+        if not os.path.isabs(directory) and not directory.startswith('~') and cfg.filename is not None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(cfg.filename)), directory)
+        import cache
+        return cache.SnapshotCache(directory)
+
+    def _new_mapping(self):
+        return self.mappings[self._get_backend()]()
+
+    def _parse_file(self, filename):
+        f_path = self._get_path(filename)
+        with timings.TIMINGS.phase('parse', table=filename), lock_file(f_path):
+            self._file_stat = file_stat(f_path)
+            self._parse_file_records(filename)
+
+    def _parse_file_records(self, filename):
+        snapshots = self._get_cache()
+        self._without_comments = False
+        if snapshots is None:
+            self._mapping = self._new_mapping()
+            for record in self.records(filename, self.load_comments):
+                self._mapping[record.key] = TableEntry.from_record(record)
+            self._without_comments = not self.load_comments
+            return
+
+        f_path = self._get_path(filename)
+        records = snapshots.load(f_path)
+        if records is not None:
+            self._mapping = self._new_mapping()
+            for key, value, comment, line_no, deleted in records:
+                self._mapping[key] = TableEntry(value, LazyComment(comment) if comment else None, line_no, deleted)
+            return
+        file_id = snapshots.file_id(f_path)
+        self._mapping = self._new_mapping()
+        for record in self.records(filename, self.load_comments):
+            self._mapping[record.key] = TableEntry.from_record(record)
+        if not self.load_comments:
+            self._without_comments = True
+            return
+        # Snapshots keep the raw comment lines, so loading them is as lazy as parsing
+        snapshots.store(f_path, [(key, entry.value, list(entry.raw_comment), entry.line_no, entry.deleted)
+                                 for key, entry in self._mapping.items()], file_id)
+
+    def _map_file(self, filename):
+        f_path = self._get_path(filename)
+        try:
+            with timings.TIMINGS.phase('parse', table=filename, backend='mmap'), lock_file(f_path):
+                self._file_stat = file_stat(f_path)
+                self._mapping = MappedTable(f_path)
+        except ParserError as e:
+            raise FactoryError("Error while parsing %s under %s" % (filename, f_path)) from e
+
     def serialize(self, original_order=False, print_system_comments=True):
+        if self._without_comments:
+            raise ConfigError("%s was loaded without comments and can't be written." % self.file)
         return self.serializer.serialize(self, original_order=original_order,
                                          print_system_comments=print_system_comments)
 
@@ -242,38 +602,650 @@ class Table(collections.abc.MutableMapping):
 class PostfixTable(Table):
     parser = PostfixTableParser
     files_dict_getter = load_file_config
+    config_getter = load_config
     serializer = PFTableSerializer
     table_singleton = True
+    # value -> {key: None}, built on first use and updated by __setitem__ and __delitem__ afterwards.
+    # Entries modified in place with entry.value = ... aren't tracked.
+    _reverse_index = None
+    # Key indexes, built on first use as well: domain -> {key: None} and the sorted keys for prefix queries.
+    # Both leave out the comment entries '#' and None.
+    _domain_index = None
+    _sorted_keys = None
+    # Lower-cased key -> {key: None} for lookup(), built on first use as well. postmap folds the keys of the
+    # map to lower case and Postfix does the same with the queries.
+    _folded_keys = None
+    # The order entries are written in, built on first use as well: the sorted (value, line no., seq, key)
+    # of all but the comment entries. seq keeps keys with the same value and line no. in the order of the
+    # dict, a replaced key keeps its seq. _order_items maps keys to their item and key width, _key_widths
+    # counts the widths for the width of the key column.
+    _order = None
+    _order_items = None
+    _key_widths = None
+    _order_seq = 0
+    # Set while the map of the written file has to be built, until that succeeds
+    _map_pending = False
+    # Stack of journals, see begin()
+    _journals = ()
+
+    def __setitem__(self, key, value):
+        self._track(key)
+        old = self._mapping.get(key)
+        if self._reverse_index is not None:
+            if old is not None:
+                self._unindex(key, old.value)
+            self._index(key, value.value)
+        if old is None:
+            self._index_key(key)
+        super().__setitem__(key, value)
+        self._order_key(key, value)
+
+    def __delitem__(self, key):
+        self._track(key)
+        if self._reverse_index is not None:
+            self._unindex(key, self._mapping[key].value)
+        self._unindex_key(key)
+        self._unorder_key(key)
+        super().__delitem__(key)
+
+    def _initialize(self):
+        self._reverse_index = None
+        self._domain_index = None
+        self._sorted_keys = None
+        self._folded_keys = None
+        self._order = None
+        # key -> copy of the entry as it was loaded (None if it didn't exist) for every changed key
+        self._changes = {}
+        super()._initialize()
+
+    def _track(self, key):
+        mapping = self._mapping
+        journals = self._journals
+        if key not in self._changes or journals:
+            entry = mapping.get(key)
+            entry = entry.copy() if entry is not None else None
+            if journals:
+                journals[-1].append((key, entry, key not in self._changes))
+            self._changes.setdefault(key, entry)
+
+    def clear_changes(self):
+        self._changes = {}
+
+    # Changes made between begin() and rollback() can be undone. commit() keeps them. Calls nest, every begin()
+    # pushes a journal, commit() hands it to the enclosing one and rollback() only undoes its own changes.
+    def begin(self):
+        if not self._journals:
+            self._journals = []
+        self._journals.append([])
+
+    def commit(self):
+        journal = self._journals.pop() if self._journals else []
+        if self._journals:
+            self._journals[-1].extend(journal)
+
+    def rollback(self):
+        journal = self._journals.pop() if self._journals else []
+        # Undoing isn't recorded in the enclosing journals
+        journals, self._journals = self._journals, ()
+        try:
+            for key, entry, untracked in reversed(journal):
+                if entry is None:
+                    if key in self:
+                        del self[key]
+                else:
+                    self[key] = entry.copy()
+                # Keys unchanged before begin() are unchanged again
+                if untracked:
+                    self._changes.pop(key, None)
+        finally:
+            self._journals = journals
+
+    def is_dirty(self):
+        return '_mapping' in self.__dict__ and bool(self._changes)
+
+    def changed_on_disk(self, path):
+        return self._file_stat != file_stat(path)
+
+    def rebase(self):
+        # Reloads the file someone else changed since it was loaded and applies the changes made here on top of
+        # it. Raises a ConflictError and keeps the table as it was if both changed the same key differently.
+        ours = {key: self._mapping.get(key) for key in self._changes}
+        base = self._changes
+        state = {name: self.__dict__.get(name) for name in
+                 ('_mapping', '_changes', '_reverse_index', '_domain_index', '_sorted_keys', '_folded_keys',
+                  '_order', '_order_items', '_key_widths', '_order_seq', '_file_stat')}
+        self._initialize()
+        conflicts = []
+        for key, entry in ours.items():
+            theirs = self._mapping.get(key)
+            if not self._same_or_none(base[key], theirs) and not self._same_or_none(entry, theirs):
+                conflicts.append(key)
+        if conflicts:
+            self.__dict__.update(state)
+            raise ConflictError('%s was changed by someone else, conflicting changes to %s.' %
+                                (self.file, ', '.join(sorted(str(key) for key in conflicts))))
+        for key, entry in ours.items():
+            theirs = self._mapping.get(key)
+            if self._same_or_none(entry, theirs):
+                continue
+            if entry is None:
+                del self[key]
+            else:
+                if theirs is not None:
+                    entry = entry.copy()
+                    entry.line_no = theirs.line_no
+                self[key] = entry
+
+    @classmethod
+    def _same_or_none(cls, a, b):
+        if a is None or b is None:
+            return a is b
+        return cls._same_entry(a, b)
+
+    @staticmethod
+    def _map_value(key, entry):
+        # The value postmap would write for an entry
+        if entry is None or entry.deleted or key is None or key == '#':
+            return None
+        return entry.value
+
+    def delta(self):
+        # Returns the keys with new values and the removed keys since the table was loaded
+        updates = {}
+        deletes = []
+        for key, original in self._changes.items():
+            old = self._map_value(key, original)
+            new = self._map_value(key, self._mapping.get(key))
+            if old != new:
+                if new is None:
+                    deletes.append(key)
+                else:
+                    updates[key] = new
+        return updates, deletes
+
+    def _index(self, key, value):
+        if value is not None:
+            self._reverse_index.setdefault(value, {})[key] = None
+
+    def _unindex(self, key, value):
+        keys = self._reverse_index.get(value)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._reverse_index[value]
+
+    def _get_reverse_index(self):
+        if self._reverse_index is None:
+            # Loading the table resets the index
+            mapping = self._mapping
+            index = {}
+            for key, entry in mapping.items():
+                if entry.value is not None:
+                    index.setdefault(entry.value, {})[key] = None
+            # Only complete indexes are visible to other readers of a session
+            self._reverse_index = index
+        return self._reverse_index
+
+    @staticmethod
+    def _domain(key):
+        return key.rpartition('@')[2].lower() if '@' in key else ''
+
+    def _index_key(self, key):
+        if key is None or key == '#':
+            return
+        if self._domain_index is not None:
+            self._domain_index.setdefault(self._domain(key), {})[key] = None
+        if self._sorted_keys is not None:
+            bisect.insort(self._sorted_keys, key)
+        if self._folded_keys is not None:
+            self._folded_keys.setdefault(key.lower(), {})[key] = None
+
+    def _unindex_key(self, key):
+        if key is None or key == '#':
+            return
+        if self._domain_index is not None:
+            keys = self._domain_index.get(self._domain(key))
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del self._domain_index[self._domain(key)]
+        if self._sorted_keys is not None:
+            i = bisect.bisect_left(self._sorted_keys, key)
+            if i < len(self._sorted_keys) and self._sorted_keys[i] == key:
+                del self._sorted_keys[i]
+        if self._folded_keys is not None:
+            keys = self._folded_keys.get(key.lower())
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del self._folded_keys[key.lower()]
+
+    def keys_in_domain(self, domain):
+        # Keys of the form local@domain, '@domain' included
+        if self._domain_index is None:
+            # Loading the table resets the indexes
+            mapping = self._mapping
+            index = {}
+            for key in mapping:
+                if key is not None and key != '#':
+                    index.setdefault(self._domain(key), {})[key] = None
+            self._domain_index = index
+        return list(self._domain_index.get(domain.lower(), ()))
+
+    def keys_with_prefix(self, prefix):
+        return list(self.iter_keys_with_prefix(prefix))
+
+    def iter_keys_with_prefix(self, prefix):
+        # The keys starting with prefix in sorted order, one by one from the sorted key index
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(key for key in self._mapping if key is not None and key != '#')
+        keys = self._sorted_keys
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            yield keys[i]
+
+    def sorted_records(self):
+        # The table as it is in memory as TableRecords, the header first, the entries sorted by key, the footer last
+        if '#' in self:
+            yield TableRecord('HEADER', '#', None, self['#'].comment, self['#'].line_no)
+        for key in self.iter_keys_with_prefix(''):
+            entry = self[key]
+            yield TableRecord('DELETED' if entry.deleted else 'ENTRY', key, entry.value, entry.comment, entry.line_no)
+        if None in self:
+            yield TableRecord('FOOTER', None, None, self[None].comment, self[None].line_no)
+
+    @staticmethod
+    def _key_width(key, entry):
+        return len(key) + 4 if entry.deleted else len(key)
+
+    def _get_order(self):
+        if self._order is None:
+            mapping = self._mapping
+            items = {}
+            widths = collections.Counter()
+            for seq, (key, entry) in enumerate(mapping.items()):
+                if key is None or key == '#':
+                    continue
+                width = self._key_width(key, entry)
+                items[key] = ((entry.value or '', entry.line_no, seq, key), width)
+                widths[width] += 1
+            self._order_items = items
+            self._key_widths = widths
+            self._order_seq = len(mapping)
+            self._order = sorted(item for item, _ in items.values())
+        return self._order
+
+    def _order_key(self, key, entry):
+        if self._order is None or key is None or key == '#':
+            return
+        old = self._order_items.get(key)
+        if old is None:
+            seq = self._order_seq
+            self._order_seq += 1
+        else:
+            seq = old[0][2]
+            self._unorder_key(key)
+        item = (entry.value or '', entry.line_no, seq, key)
+        width = self._key_width(key, entry)
+        bisect.insort(self._order, item)
+        self._order_items[key] = (item, width)
+        self._key_widths[width] += 1
+
+    def _unorder_key(self, key):
+        old = self._order_items.pop(key, None) if self._order is not None else None
+        if old is None:
+            return
+        item, width = old
+        del self._order[bisect.bisect_left(self._order, item)]
+        self._key_widths[width] -= 1
+        if not self._key_widths[width]:
+            del self._key_widths[width]
+
+    def sorted_entries(self):
+        # (key, entry) of all but the comment entries in the order they are written in: by value, then by line
+        # number. Entries changed in place instead of being set again keep their old position.
+        mapping = self._mapping
+        for item in self._get_order():
+            yield item[3], mapping[item[3]]
+
+    def key_width(self):
+        # Length of the longest key, '#-- ' of deleted entries included
+        self._get_order()
+        return max(self._key_widths, default=0)
+
+    @staticmethod
+    def _same_entry(a, b):
+        return a.value == b.value and a.deleted == b.deleted and tuple(a.comment) == tuple(b.comment)
+
+    @staticmethod
+    def diff_mappings(old, new):
+        # Yields ('set', key, entry) and ('del', key, None) turning old into new, comment entries included.
+        # One pass over each mapping.
+        for key, entry in new.items():
+            before = old.get(key)
+            if before is None or not PostfixTable._same_entry(before, entry):
+                yield 'set', key, entry
+        for key in old:
+            if key not in new:
+                yield 'del', key, None
+
+    def diff(self, other):
+        # The changes turning this table into other
+        return self.diff_mappings(self, other)
+
+    def apply(self, op, key, entry=None):
+        # Applies one change yielded by diff_mappings. Returns whether the table changed.
+        if op == 'del':
+            if key not in self:
+                return False
+            del self[key]
+            return True
+        old = self.get(key)
+        if old is not None:
+            if self._same_entry(old, entry):
+                return False
+            entry = entry.copy()
+            entry.line_no = old.line_no
+        self[key] = entry
+        return True
+
+    def merge(self, entries, replace=False):
+        # Merges (key, entry) pairs sorted by key in one pass along the sorted keys of the table. Only keys
+        # which are new or differ are set, with replace keys missing from entries are removed. Doesn't touch
+        # the comment entries '#' and None. Returns the numbers of added, changed and removed keys.
+        keys = self.keys_with_prefix('')
+        # The merged keys replace the sorted keys afterwards instead of inserting them one by one
+        self._sorted_keys = None
+        merged = []
+        added = changed = removed = 0
+        i = 0
+        previous = None
+        for key, entry in entries:
+            if previous is not None and key <= previous:
+                raise ConfigError("Key '%s' isn't sorted or appears more than once." % key)
+            previous = key
+            while i < len(keys) and keys[i] < key:
+                if replace:
+                    del self[keys[i]]
+                    removed += 1
+                else:
+                    merged.append(keys[i])
+                i += 1
+            if i < len(keys) and keys[i] == key:
+                i += 1
+                old = self[key]
+                if not self._same_entry(old, entry):
+                    entry.line_no = old.line_no
+                    self[key] = entry
+                    changed += 1
+            else:
+                self[key] = entry
+                added += 1
+            merged.append(key)
+        for key in keys[i:]:
+            if replace:
+                del self[key]
+                removed += 1
+            else:
+                merged.append(key)
+        self._sorted_keys = merged
+        return added, changed, removed
+
+    def keys_for(self, value, include_deleted=False):
+        keys = self._get_reverse_index().get(value, ())
+        if include_deleted:
+            return list(keys)
+        return [key for key in keys if not self._mapping[key].deleted]
+
+    def lookup(self, key):
+        # Returns the value Postfix would find for key in the map built from this table. Keys are compared
+        # case-insensitively like in the map, of keys differing only in case the first one in the file wins.
+        if key is None or key == '#':
+            return None
+        if self._folded_keys is None:
+            # Loading the table resets the indexes
+            mapping = self._mapping
+            index = {}
+            for k in mapping:
+                if k is not None and k != '#':
+                    index.setdefault(k.lower(), {})[k] = None
+            self._folded_keys = index
+        mapping = self._mapping
+        for k in sorted(self._folded_keys.get(key.lower(), ()), key=lambda k: mapping[k].line_no):
+            value = self._map_value(k, mapping[k])
+            if value is not None:
+                return value
+        return None
 
     def del_entry(self, key, comment_out=False):
         if key in self:
             if comment_out:
+                self._track(key)
                 self[key].deleted = True
+                self._order_key(key, self[key])
             else:
                 del self[key]
 
 
+class ValuePool(object):
+    # Dictionary encoding for the values of the ColumnarTables. Every distinct value is stored once and rows
+    # only hold its id, id 0 is reserved for None. Values are counted and dropped once no row holds them,
+    # so a long running process doesn't keep every value it ever saw. Their ids are reused.
+    def __init__(self):
+        self._ids = {None: 0}
+        self._values = [None]
+        self._counts = [0]
+        self._free = []
+        # Tables of sessions in other threads share the pool
+        self._lock = _thread.allocate_lock()
+
+    def intern(self, value):
+        # Returns the id of value and counts one more use of it
+        with self._lock:
+            value_id = self._ids.get(value)
+            if value_id is None:
+                if self._free:
+                    value_id = self._free.pop()
+                    self._values[value_id] = value
+                else:
+                    value_id = len(self._values)
+                    self._values.append(value)
+                    self._counts.append(0)
+                self._ids[value] = value_id
+            if value_id:
+                self._counts[value_id] += 1
+            return value_id
+
+    def release(self, value_id):
+        if value_id:
+            with self._lock:
+                self._counts[value_id] -= 1
+                if not self._counts[value_id]:
+                    del self._ids[self._values[value_id]]
+                    self._values[value_id] = None
+                    self._free.append(value_id)
+
+    def lookup(self, value):
+        return self._ids.get(value)
+
+    def value(self, value_id):
+        return self._values[value_id]
+
+    def __len__(self):
+        return len(self._ids)
+
+
+# Shared by all ColumnarTables, the same addresses in virtual-alias, sender-login-maps and the users are
+# stored once and compared by id
+VALUE_POOL = ValuePool()
+
+
 class TableEntry(object):
+    __slots__ = ('value', '_comment', 'line_no', 'deleted')
+    # Shared by all entries without comments. It's immutable, so assign a new list to add comments.
+    EMPTY_COMMENT = ()
+
     def __init__(self, value=None, comment=None, line_no=0, deleted=False):
-        if comment is None:
-            comment = []
+        if not comment:
+            comment = self.EMPTY_COMMENT
         self.value = value
-        self.comment = comment
+        self._comment = comment
         self.line_no = line_no
         self.deleted = deleted
 
+    @property
+    def comment(self):
+        comment = self._comment
+        if type(comment) is LazyComment:
+            comment = self._comment = comment.materialize()
+        return comment
+
+    @comment.setter
+    def comment(self, comment):
+        self._comment = comment
+
+    @property
+    def lazy_comment(self):
+        # The comment without materializing it, for copying it to other entries
+        return self._comment
+
+    @property
+    def raw_comment(self):
+        # The comment lines as they are written to the file
+        comment = self.lazy_comment
+        if type(comment) is LazyComment:
+            return comment.lines
+        return ['# ' + line for line in comment]
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record.value, record.comment, record.line_no, record.kind == 'DELETED')
+
     def __eq__(self, other):
         is_class = isinstance(other, TableEntry)
-        return is_class and self.value == other.value and self.comment == other.comment \
+        return is_class and self.value == other.value and tuple(self.comment) == tuple(other.comment) \
                and self.line_no == other.line_no and self.deleted == other.deleted
 
     def __repr__(self):
         return "Value: '%s', Comment: '%s', Line No.: '%s', Deleted: '%s'" % \
-               (self.value, self.comment, self.line_no, self.deleted)
+               (self.value, list(self.comment), self.line_no, self.deleted)
 
     def get_value(self):
         return '# ' + self.value if self.deleted else self.value
 
+    def copy(self):
+        return TableEntry(self.value, self.lazy_comment, self.line_no, self.deleted)
+
+    def set(self, other):
+        self.value = other.value
+        self.comment = other.lazy_comment
+        self.line_no = other.line_no
+        self.deleted = other.deleted
+
+
+class ColumnarEntry(TableEntry):
+    # A view onto one row of a ColumnarTable
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    @property
+    def value(self):
+        return self._table._pool.value(self._table._values[self._row])
+
+    @value.setter
+    def value(self, value):
+        table = self._table
+        value_id = table._pool.intern(value)
+        table._pool.release(table._values[self._row])
+        table._values[self._row] = value_id
+
+    @property
+    def comment(self):
+        comment = self._table._comments.get(self._row, self.EMPTY_COMMENT)
+        if type(comment) is LazyComment:
+            comment = self._table._comments[self._row] = comment.materialize()
+        return comment
+
+    @property
+    def lazy_comment(self):
+        return self._table._comments.get(self._row, self.EMPTY_COMMENT)
+
+    @comment.setter
+    def comment(self, comment):
+        if comment:
+            self._table._comments[self._row] = comment
+        else:
+            self._table._comments.pop(self._row, None)
+
+    @property
+    def line_no(self):
+        return self._table._line_nos[self._row]
+
+    @line_no.setter
+    def line_no(self, line_no):
+        self._table._line_nos[self._row] = line_no
+
+    @property
+    def deleted(self):
+        return bool(self._table._deleted[self._row])
+
+    @deleted.setter
+    def deleted(self, deleted):
+        self._table._deleted[self._row] = 1 if deleted else 0
+
+
+class ColumnarTable(collections.abc.MutableMapping):
+    # Stores the entries in parallel arrays instead of one object per entry. Rows of deleted keys
+    # aren't reused, so views handed out by __getitem__ never change their meaning.
+    def __init__(self, pool=None):
+        self._rows = {}
+        # Value ids of the rows in _pool
+        self._pool = VALUE_POOL if pool is None else pool
+        self._values = array.array('I')
+        self._line_nos = array.array('q')
+        self._deleted = bytearray()
+        self._comments = {}
+
+    def __getitem__(self, key):
+        return ColumnarEntry(self, self._rows[key])
+
+    def __setitem__(self, key, entry):
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._values)
+            self._values.append(self._pool.intern(entry.value))
+            self._line_nos.append(entry.line_no)
+            self._deleted.append(1 if entry.deleted else 0)
+            if entry.lazy_comment:
+                self._comments[row] = entry.lazy_comment
+            self._rows[key] = row
+        else:
+            ColumnarEntry(self, row).set(entry)
+
+    def __delitem__(self, key):
+        row = self._rows.pop(key)
+        self._pool.release(self._values[row])
+        self._values[row] = 0
+        self._comments.pop(row, None)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __del__(self):
+        # A table loaded again drops the old one, its values are released from the shared pool
+        for row in self._rows.values():
+            self._pool.release(self._values[row])
+
 
 class DovecotPasswordFile(dict):
     pass
@@ -286,10 +1258,204 @@ class Alias(object):
         self.inbox = inbox
 
 
+BatchOperation = collections.namedtuple('BatchOperation', 'line_no op args')
+BatchResult = collections.namedtuple('BatchResult', 'operation error')
+
+
+def read_batch(lines):
+    # Reads one operation per line, either as JSON object ({"op": "add", "alias": ..., "user": ...,
+    # "comment": ...}) or as plain words ("add ALIAS USER [COMMENT]", "del ALIAS", "deluser USER").
+    # Lines which can't be read are returned with an 'invalid' operation carrying the error message.
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                args = json.loads(line)
+            except ValueError as e:
+                yield BatchOperation(line_no, 'invalid', {'error': 'Invalid JSON: %s' % e})
+                continue
+            if not isinstance(args, dict) or 'op' not in args:
+                yield BatchOperation(line_no, 'invalid', {'error': "JSON operations need an 'op' entry."})
+                continue
+            op = args.pop('op')
+            if not isinstance(op, str) or not all(isinstance(value, bool if name == 'comment_out' else str)
+                                                  for name, value in args.items()):
+                yield BatchOperation(line_no, 'invalid',
+                                     {'error': "JSON arguments must be strings, 'comment_out' a boolean."})
+                continue
+        else:
+            words = line.split(None, 3)
+            op = words[0]
+            names = PFAliasConfig.batch_arguments.get(op, ())
+            if op in PFAliasConfig.batch_arguments and len(words) - 1 > len(names):
+                yield BatchOperation(line_no, 'invalid', {'error': "Too many arguments for '%s'." % op})
+                continue
+            args = dict(zip(names, words[1:]))
+        yield BatchOperation(line_no, op, args)
+
+
+# Tables handled by export and import, in this order
+TABLE_NAMES = ('virtual-alias', 'sender-login-maps', 'virtual-mailbox-users', 'virtual-mailbox-domains')
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_FIELDS = ('table', 'kind', 'key', 'value', 'deleted', 'comment')
+EXPORT_KINDS = {'ENTRY': 'entry', 'DELETED': 'entry', 'HEADER': 'header', 'FOOTER': 'footer'}
+# The keys the file comments are stored under
+EXPORT_COMMENT_KEYS = {'header': '#', 'footer': None}
+ExportRow = collections.namedtuple('ExportRow', 'line_no table key entry')
+
+
+def export_rows(name, records):
+    # One dict with EXPORT_FIELDS per TableRecord, the key of header and footer is None
+    for record in records:
+        kind = EXPORT_KINDS[record.kind]
+        yield {'table': name, 'kind': kind, 'key': record.key if kind == 'entry' else None, 'value': record.value,
+               'deleted': record.kind == 'DELETED', 'comment': list(record.comment)}
+
+
+def format_export(rows, fmt='ndjson'):
+    # Yields one line per row. CSV has a header line and joins comment lines with newlines.
+    if fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(row)
+        return
+    import csv
+    buffer = io.StringIO()
+    # Without a line terminator containing '\n', csv doesn't quote fields with newlines
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def line(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()[:-1]
+
+    yield line(EXPORT_FIELDS)
+    for row in rows:
+        yield line([row['table'], row['kind'], row['key'] or '', row['value'] or '', int(row['deleted']),
+                    '\n'.join(row['comment'])])
+
+
+def _read_export_row(line_no, row):
+    if not isinstance(row, dict):
+        raise ConfigError('Line %s: expected an object.' % line_no)
+    table = row.get('table')
+    if table not in TABLE_NAMES:
+        raise ConfigError("Line %s: unknown table '%s'." % (line_no, table))
+    kind = row.get('kind') or 'entry'
+    comment = row.get('comment') or []
+    if isinstance(comment, str):
+        comment = comment.split('\n')
+    if not isinstance(comment, list) or not all(isinstance(c, str) for c in comment):
+        raise ConfigError('Line %s: comment has to be a list of lines.' % line_no)
+    if kind in EXPORT_COMMENT_KEYS:
+        return ExportRow(line_no, table, EXPORT_COMMENT_KEYS[kind], TableEntry(None, comment))
+    if kind != 'entry':
+        raise ConfigError("Line %s: unknown kind '%s'." % (line_no, kind))
+    key = row.get('key')
+    value = row.get('value')
+    if not isinstance(key, str) or not key or key.startswith('#') or len(key.split()) != 1:
+        raise ConfigError("Line %s: invalid key '%s'." % (line_no, key))
+    if not isinstance(value, str) or not value.strip():
+        raise ConfigError("Line %s: entry '%s' has no value." % (line_no, key))
+    deleted = row.get('deleted') in (True, 1, '1', 'true', 'True')
+    return ExportRow(line_no, table, key, TableEntry(value.strip(), comment, sys.maxsize, deleted))
+
+
+def read_export(lines, fmt='ndjson'):
+    # Reads what format_export wrote. Raises a ConfigError on the first invalid row.
+    if fmt == 'csv':
+        import csv
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield _read_export_row(reader.line_num, row)
+        return
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise ConfigError('Line %s: invalid JSON: %s' % (line_no, e))
+        yield _read_export_row(line_no, row)
+
+
+PatchOp = collections.namedtuple('PatchOp', 'line_no op table key entry')
+
+
+def format_patch(name, ops):
+    # One compact JSON object per change: op, table and key, for 'set' also the entry like in export,
+    # leaving out empty comments and deleted flags
+    kinds = {key: kind for kind, key in EXPORT_COMMENT_KEYS.items()}
+    for op, key, entry in ops:
+        row = {'op': op, 'table': name}
+        if key in kinds:
+            row['kind'] = kinds[key]
+        else:
+            row['key'] = key
+        if op == 'set':
+            if entry.value is not None:
+                row['value'] = entry.value
+            if entry.deleted:
+                row['deleted'] = True
+            if entry.comment:
+                row['comment'] = list(entry.comment)
+        yield json.dumps(row, separators=(',', ':'))
+
+
+def read_patch(lines):
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise ConfigError('Line %s: invalid JSON: %s' % (line_no, e))
+        op = row.get('op') if isinstance(row, dict) else None
+        if op not in ('set', 'del'):
+            raise ConfigError("Line %s: unknown op '%s'." % (line_no, op))
+        if op == 'del':
+            # Deletions only need a key, validated with a dummy value
+            row = dict(row, value='-', comment=[], deleted=False)
+        item = _read_export_row(line_no, row)
+        yield PatchOp(line_no, op, item.table, item.key, item.entry if op == 'set' else None)
+
+
+Resolution = collections.namedtuple('Resolution', 'address recipients senders')
+Problem = collections.namedtuple('Problem', 'kind table key detail')
+
+
+class LazyTable(object):
+    # Class attribute returning the table, which is only created on first access instead of on import
+    def __init__(self, name):
+        self.name = name
+        self.attr = None
+
+    def __set_name__(self, owner, attr):
+        self.attr = attr
+
+    def __get__(self, obj, owner=None):
+        session = getattr(obj, 'session', None)
+        table = PostfixTable(self.name) if session is None else session.table(self.name)
+        if obj is not None:
+            obj.__dict__[self.attr] = table
+        return table
+
+
 class PFAliasConfig(object):
-    _virtual_alias = PostfixTable('virtual-alias')
-    _sender_login_maps = PostfixTable('sender-login-maps')
-    _users = PostfixTable('virtual-mailbox-users')
+    # Alias chains deeper than this are cut off like loops
+    resolve_depth_limit = 100
+    _virtual_alias = LazyTable('virtual-alias')
+    _sender_login_maps = LazyTable('sender-login-maps')
+    _users = LazyTable('virtual-mailbox-users')
+    _domains = LazyTable('virtual-mailbox-domains')
+    # Takes the tables from this session.Session instead of the global ones
+    session = None
+
+    def __init__(self, session=None):
+        if session is not None:
+            self.session = session
 
     def add_alias(self, alias, user, comment='', virtual_alias=True, sender_login_maps=True):
         if alias in self._virtual_alias and virtual_alias:
@@ -338,22 +1504,298 @@ class PFAliasConfig(object):
 
         return aliases
 
+    def _filter_keys(self, domain=None, user=None, prefix=None):
+        # Keys of both tables matching all given filters, looked up in the table indexes. None without filters.
+        tables = (self._virtual_alias, self._sender_login_maps)
+        selections = []
+        if user is not None:
+            selections.append([table.keys_for(user, include_deleted=True) for table in tables])
+        if domain is not None:
+            selections.append([table.keys_in_domain(domain) for table in tables])
+        if prefix is not None:
+            selections.append([table.keys_with_prefix(prefix) for table in tables])
+        keys = None
+        for va_keys, slm_keys in sorted(selections, key=lambda s: len(s[0]) + len(s[1])):
+            selected = dict.fromkeys(va_keys)
+            selected.update(dict.fromkeys(slm_keys))
+            keys = selected if keys is None else {key: None for key in keys if key in selected}
+        return keys
+
+    def iter_aliases(self, domain=None, user=None, prefix=None, offset=0, limit=None, ordered=True):
+        # Aliases in the order of get_alias_list(True, True) without the comment entries. Only the aliases
+        # of the requested page are created. Without ordered they come in key order, unfiltered or only
+        # filtered by prefix straight from the sorted key indexes, so nothing is sorted before the first one.
+        va = self._virtual_alias
+        slm = self._sender_login_maps
+        if not ordered:
+            if domain is None and user is None:
+                keys = self._iter_sorted_keys(prefix or '')
+            else:
+                keys = sorted(self._filter_keys(domain, user, prefix))
+            for key in itertools.islice(keys, offset, offset + limit if limit is not None else None):
+                yield self.get_alias(key)
+            return
+        keys = self._filter_keys(domain, user, prefix)
+        if keys is None:
+            keys = itertools.chain(va, (key for key in slm if key not in va))
+
+        def sort_key(key):
+            va_entry = va.get(key)
+            slm_entry = slm.get(key)
+            line_no = va_entry.line_no if va_entry is not None else slm_entry.line_no
+            return (slm_entry.value or '' if slm_entry is not None else '',
+                    va_entry.value or '' if va_entry is not None else '', va_entry is None, line_no)
+
+        keys = sorted((key for key in keys if key is not None and key != '#'), key=sort_key)
+        for key in itertools.islice(keys, offset, offset + limit if limit is not None else None):
+            yield self.get_alias(key)
+
+    def _iter_sorted_keys(self, prefix):
+        # The keys of both tables starting with prefix, sorted and each once
+        import heapq
+        previous = None
+        for key in heapq.merge(self._virtual_alias.iter_keys_with_prefix(prefix),
+                               self._sender_login_maps.iter_keys_with_prefix(prefix)):
+            if key != previous:
+                yield key
+            previous = key
+
+    def get_user_aliases(self, user):
+        aliases = self._virtual_alias.keys_for(user)
+        known = set(aliases)
+        aliases += [a for a in self._sender_login_maps.keys_for(user) if a not in known]
+        return [self.get_alias(a) for a in aliases]
+
     def del_virtual_alias_user(self, user, comment_out=False):
-        aliases = []
-        for a, v in self._virtual_alias.items():
-            if v.value == user:
-                aliases.append(a)
-        for a in aliases:
+        for a in self._virtual_alias.keys_for(user, include_deleted=True):
             self._virtual_alias.del_entry(a, comment_out)
 
     def del_sender_login_maps_user(self, user, comment_out=False):
-        aliases = []
-        for a, v in self._sender_login_maps.items():
-            if v.value == user:
-                aliases.append(a)
-        for a in aliases:
+        for a in self._sender_login_maps.keys_for(user, include_deleted=True):
             self._sender_login_maps.del_entry(a, comment_out)
 
+    # Positional arguments of the plain batch format, optional ones last
+    batch_arguments = {
+        'add': ('alias', 'user', 'comment'),
+        'del': ('alias',),
+        'deluser': ('user',),
+    }
+
+    def _batch_add(self, alias, user, comment=''):
+        self.add_alias(alias, user, comment)
+
+    def _batch_del(self, alias, comment_out=False):
+        if alias not in self._virtual_alias and alias not in self._sender_login_maps:
+            raise ConfigError("Alias '%s' does not exist." % alias)
+        self.delete_alias(alias, comment_out)
+
+    def _batch_deluser(self, user, comment_out=False):
+        self.del_sender_login_maps_user(user, comment_out)
+        self.del_virtual_alias_user(user, comment_out)
+
+    def apply_batch(self, operations, atomic=False):
+        # With atomic, all changes are undone if one of the operations fails
+        import inspect
+        tables = (self._virtual_alias, self._sender_login_maps)
+        if atomic:
+            for table in tables:
+                table.begin()
+        results = []
+        try:
+            for operation in operations:
+                try:
+                    if operation.op == 'invalid':
+                        raise ConfigError(operation.args['error'])
+                    method = getattr(self, '_batch_' + operation.op, None)
+                    if operation.op not in self.batch_arguments or method is None:
+                        raise ConfigError("Unknown operation '%s'." % operation.op)
+                    try:
+                        inspect.signature(method).bind(**operation.args)
+                    except TypeError:
+                        raise ConfigError("Wrong arguments for operation '%s'." % operation.op)
+                    method(**operation.args)
+                except ConfigError as e:
+                    results.append(BatchResult(operation, str(e)))
+                else:
+                    results.append(BatchResult(operation, None))
+        except BaseException:
+            # Other errors stop the batch, the journals are closed in any case
+            if atomic:
+                for table in tables:
+                    table.rollback()
+            raise
+        if atomic:
+            failed = any(result.error is not None for result in results)
+            for table in tables:
+                if failed:
+                    table.rollback()
+                else:
+                    table.commit()
+        return results
+
+    @staticmethod
+    def _lookup_keys(address):
+        # Postfix' lookup order for virtual addresses
+        user, at, domain = address.rpartition('@')
+        if not at:
+            return [address]
+        return [address, user, '@' + domain]
+
+    def _lookup_address(self, table, address):
+        for key in self._lookup_keys(address):
+            value = table.lookup(key)
+            if value is not None:
+                return [v.strip() for v in value.split(',') if v.strip()]
+        return None
+
+    def _expand(self, address, memo, active):
+        # Returns the recipients of address and whether a loop or the depth limit cut the expansion short.
+        # Such results depend on the addresses being expanded around them, only the others are memoized.
+        # Otherwise the result for an address would depend on which address of a batch came first.
+        result = memo.get(address)
+        if result is not None:
+            return result, False
+        targets = self._lookup_address(self._virtual_alias, address)
+        if targets is None:
+            return [address], False
+        if address in active or len(active) >= self.resolve_depth_limit:
+            return [address], True
+
+        active.add(address)
+        result = []
+        cut = False
+        for target in targets:
+            # An alias pointing to itself delivers to the address as well
+            if target == address:
+                expanded = [target]
+            else:
+                expanded, target_cut = self._expand(target, memo, active)
+                cut = cut or target_cut
+            result.extend(r for r in expanded if r not in result)
+        active.discard(address)
+        if not cut:
+            memo[address] = result
+        return result, cut
+
+    def resolve(self, addresses):
+        # Yields where mail for each address gets delivered and who may send as it. Expansions are
+        # shared between the addresses, so common targets are resolved only once.
+        memo = {}
+        for address in addresses:
+            recipients, _ = self._expand(address, memo, set())
+            senders = self._lookup_address(self._sender_login_maps, address) or []
+            yield Resolution(address, recipients, senders)
+
+    def _find_key(self, table, address):
+        for key in self._lookup_keys(address):
+            if table.lookup(key) is not None:
+                return key
+        return None
+
+    @staticmethod
+    def _live_items(table):
+        for key, entry in table.items():
+            if key is not None and key != '#' and not entry.deleted:
+                yield key, entry.value
+
+    @staticmethod
+    def _find_duplicates(name, table):
+        lines = {}
+        for record in table.records():
+            if record.kind in ('ENTRY', 'DELETED'):
+                if record.key in lines:
+                    yield Problem('duplicate', name, record.key, 'line %s repeats line %s' %
+                                  (record.line_no, lines[record.key]))
+                else:
+                    lines[record.key] = record.line_no
+
+    @staticmethod
+    def _find_cycles(graph):
+        # Tarjan's strongly connected components, iterative so long alias chains can't hit the recursion
+        # limit. Returns the components with more than one node.
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        for root in graph:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(graph[root]))]
+            while work:
+                node, targets = work[-1]
+                for target in targets:
+                    if target not in index:
+                        index[target] = low[target] = len(index)
+                        stack.append(target)
+                        on_stack.add(target)
+                        work.append((target, iter(graph.get(target, ()))))
+                        break
+                    elif target in on_stack:
+                        low[node] = min(low[node], index[target])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1:
+                            cycles.append(component[::-1])
+        return cycles
+
+    def check(self, duplicates=True):
+        # Validates the tables against each other with one pass over each of them
+        problems = []
+        if duplicates:
+            for name, table in (('virtual-alias', self._virtual_alias),
+                                ('sender-login-maps', self._sender_login_maps),
+                                ('virtual-mailbox-users', self._users)):
+                problems.extend(self._find_duplicates(name, table))
+
+        users = {key for key, _ in self._live_items(self._users)}
+        domains = {key for key, _ in self._live_items(self._domains)}
+
+        graph = {}
+        for alias, value in self._live_items(self._virtual_alias):
+            edges = []
+            for target in value.split(','):
+                target = target.strip()
+                if not target or target == alias:
+                    continue
+                key = self._find_key(self._virtual_alias, target)
+                if key is not None:
+                    if key != alias:
+                        edges.append(key)
+                    continue
+                user, at, domain = target.rpartition('@')
+                if target not in users and (not at or domain in domains):
+                    problems.append(Problem('dangling', 'virtual-alias', alias,
+                                            "target '%s' is neither a user nor an alias" % target))
+            graph[alias] = edges
+
+        for alias, value in self._live_items(self._sender_login_maps):
+            if alias not in graph:
+                problems.append(Problem('orphan', 'sender-login-maps', alias, 'no entry in virtual-alias'))
+            for owner in value.split(','):
+                owner = owner.strip()
+                if owner and owner not in users:
+                    problems.append(Problem('dangling', 'sender-login-maps', alias,
+                                            "sender '%s' is not a user" % owner))
+
+        for cycle in self._find_cycles(graph):
+            problems.append(Problem('loop', 'virtual-alias', cycle[0], ' -> '.join(cycle + cycle[:1])))
+        return problems
+
     def serialize(self, virtual_alias=True, sender_login_maps=True):
         out = ''
         if virtual_alias:
@@ -367,21 +1809,96 @@ class PFUserConfig(object):
     pf_files = ('virtual-mailbox-users',)
 
 
+class PostmapWriter(object):
+    def __init__(self, app):
+        self.app = app
+
+    def check(self):
+        self.app._which(self.app._getpostmap())
+
+    def write(self, path, table):
+        self.app._exec_postmap(path, table)
+
+
+class CdbMapWriter(object):
+    # Writes the map Postfix reads as cdb:path directly from the table
+    suffix = '.cdb'
+
+    def __init__(self, app):
+        self.app = app
+
+    def check(self):
+        pass
+
+    def write(self, path, table):
+        with timings.TIMINGS.phase('cdb', file=path):
+            self._write(path, table)
+
+    def _write(self, path, table):
+        import cdb
+        keys = set()
+        with cdb.CdbWriter(path + self.suffix) as writer:
+            for key, entry in table.items():
+                value = PostfixTable._map_value(key, entry)
+                # postmap folds keys to lower case and keeps the first of duplicate keys
+                key = key.lower() if key is not None else None
+                if value is not None and key not in keys:
+                    keys.add(key)
+                    writer.add(key, value)
+
+
 class App(object):
     alias_config = PFAliasConfig
+    map_writers = {
+        'postmap': PostmapWriter,
+        'cdb': CdbMapWriter,
+    }
+    # Files of map types postmap can update in place with -i and -d. cdb maps can only be rebuilt, and a
+    # .cdb next to the table may also be left over from the cdb map writer.
+    map_suffixes = ('.db', '.lmdb')
+    # Column widths of 'alias list --stream', which prints rows before all of them are known
+    stream_widths = (40, 40)
+    # Actions which never write or print comments, the tables are parsed without them
+    read_only_actions = ('list_aliases', 'resolve_aliases', 'check')
+    # With a session.Session the config and the tables are the session's instead of the global ones
+    session = None
+
+    def __init__(self, session=None):
+        if session is not None:
+            self.session = session
 
     def __getattr__(self, item):
         if item == '_alias_config':
-            self._alias_config = self.alias_config()
+            self._alias_config = self.alias_config(self.session)
             return self._alias_config
         raise AttributeError()
 
+    def _load_config(self):
+        return load_config() if self.session is None else self.session.config
+
+    def _load_file_config(self):
+        return load_file_config() if self.session is None else self.session.file_config
+
+    def _table(self, name):
+        return PostfixTable(name) if self.session is None else self.session.table(name)
+
     def list_aliases(self, args):
         if hasattr(args, 'as_saved') and args.as_saved:
             return self._alias_config.serialize()
 
+        # Other commands show their result through list_aliases, the filters have dests of their own so they
+        # don't pick up the arguments of those commands
+        stream = getattr(args, 'stream', False)
+        aliases = self._alias_config.iter_aliases(getattr(args, 'filter_domain', None),
+                                                  getattr(args, 'filter_user', None),
+                                                  getattr(args, 'filter_prefix', None),
+                                                  getattr(args, 'offset', None) or 0, getattr(args, 'limit', None),
+                                                  ordered=not stream)
+        if stream:
+            return self._stream_aliases(aliases)
+
         out = []
-        aliases = self._alias_config.get_alias_list(True, True)
+        aliases = list(aliases)
         max_alias_len = 6
         max_inbox_len = 6
         max_sender_len = 7
@@ -416,9 +1933,24 @@ class App(object):
                 out.append(alias.alias + ' ' * alias_spaces + inbox + ' ' * inbox_spaces + sender)
         return "\n".join(out)
 
-    @staticmethod
-    def _getpostmap():
-        c = load_config()
+    def _stream_aliases(self, aliases):
+        alias_width, inbox_width = self.stream_widths
+        yield '%-*s %-*s %s' % (alias_width, 'Alias:', inbox_width, 'Inbox:', 'Sender:')
+        yield '-' * (alias_width + inbox_width + 9)
+        for alias in aliases:
+            inbox = alias.inbox.get_value() if alias.inbox and alias.inbox.value else ''
+            sender = alias.sender.get_value() if alias.sender and alias.sender.value else ''
+            yield '%-*s %-*s %s' % (alias_width, alias.alias, inbox_width, inbox, sender)
+
+    def _get_map_writer(self):
+        name = self._load_config().get('map-writer', DEFAULT_MAP_WRITER)
+        writer = self.map_writers.get(name)
+        if writer is None:
+            raise ConfigError("Unknown map writer '%s'." % name)
+        return writer(self)
+
+    def _getpostmap(self):
+        c = self._load_config()
         postmap = c.get('postmap')
         if postmap is None:
             postmap = DEFAULT_POSTMAP
@@ -426,38 +1958,118 @@ class App(object):
 
     @staticmethod
     def _which(cmd):
+        import shutil
         path = shutil.which(cmd)
         if path is None:
             raise RuntimeError("Command %s couldn't be found. No changes have been written." % cmd)
 
-    def _exec(self, args, stdin=None, stdout=None, stderr=None):
+    def _exec(self, args, stdin=None, stdout=None, stderr=None, input=None):
+        import subprocess
         with subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr) as p:
-            p.communicate()
-            print("Executed: %s" % " ".join(args))
+            p.communicate(input)
+            self._report("Executed: %s" % " ".join(args))
             return p
 
-    def _exec_postmap(self, file):
-        args = [self._getpostmap(), file]
-        p = self._exec(args, stdout=subprocess.PIPE)
+    def _report(self, line):
+        print(line)
+
+    def _exec_postmap(self, file, table=None):
+        if table is not None and self._exec_postmap_incremental(file, table):
+            return
+        import subprocess
+        with timings.TIMINGS.phase('postmap', file=file):
+            args = [self._getpostmap(), file]
+            p = self._exec(args, stdout=subprocess.PIPE)
         if p.returncode != 0:
             raise RuntimeError("Return code from %s was %s. Unable to generate %s.db." %
                                (self._getpostmap(), p.returncode, file))
 
+    def _exec_postmap_incremental(self, file, table):
+        # Feeds only the changes since the table was loaded to postmap. Returns False if the map has to
+        # be rebuilt instead, because it doesn't exist yet or the changes exceed the configured share
+        # of the table.
+        threshold = self._load_config().get('postmap-incremental-threshold', DEFAULT_INCREMENTAL_THRESHOLD)
+        if not threshold or not any(os.path.exists(file + suffix) for suffix in self.map_suffixes):
+            return False
+        updates, deletes = table.delta()
+        if len(updates) + len(deletes) > threshold * len(table):
+            return False
+        with timings.TIMINGS.phase('postmap', file=file, incremental=True):
+            return self._exec_postmap_delta(file, updates, deletes)
+
+    def _exec_postmap_delta(self, file, updates, deletes):
+        import subprocess
+        postmap = self._getpostmap()
+        if deletes:
+            data = ''.join(key + '\n' for key in deletes).encode()
+            p = self._exec([postmap, '-d', '-', file], stdin=subprocess.PIPE, stdout=subprocess.PIPE, input=data)
+            # 1 means that some keys weren't in the map
+            if p.returncode not in (0, 1):
+                raise RuntimeError("Return code from %s was %s. Unable to delete entries from %s.db." %
+                                   (postmap, p.returncode, file))
+        if updates:
+            data = ''.join('%s %s\n' % item for item in updates.items()).encode()
+            p = self._exec([postmap, '-i', '-r', file], stdin=subprocess.PIPE, stdout=subprocess.PIPE, input=data)
+            if p.returncode != 0:
+                raise RuntimeError("Return code from %s was %s. Unable to update %s.db." %
+                                   (postmap, p.returncode, file))
+        return True
+
+    @staticmethod
+    def _file_hash(path):
+        import hashlib
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            return None
+        return digest.digest()
+
+    def _save_table(self, path, table):
+        # Writes and postmaps the table if it differs from the file. Returns whether it did.
+        if not table.is_dirty():
+            return False
+        import hashlib
+        with lock_file(path, exclusive=True):
+            # Another process saved the table since it was loaded here
+            if table.changed_on_disk(path):
+                table.rebase()
+            with timings.TIMINGS.phase('serialize', file=path):
+                data = table.serialize()
+            changed = hashlib.sha256(data.encode()).digest() != self._file_hash(path)
+            if changed:
+                with timings.TIMINGS.phase('write', file=path):
+                    write_file(path, data)
+                table._file_stat = file_stat(path)
+            # The file may already be written by a save whose map failed, then the map is built again
+            written = changed or table._map_pending
+            if written:
+                table._map_pending = True
+                self._get_map_writer().write(path, table)
+                table._map_pending = False
+            table.clear_changes()
+            table._file_stat = file_stat(path)
+        return written
+
+    def _save_tables(self, tables):
+        fc = self._load_file_config()
+        saved = [name for name, table in tables if self._save_table(fc[name], table)]
+        if not saved:
+            return 'Nothing to save, the tables are unchanged.'
+        return 'Successfully saved %s.' % ', '.join(saved)
+
+    def save_alias_tables(self):
+        self._get_map_writer().check()
+        return self._save_tables([('virtual-alias', self._alias_config._virtual_alias),
+                                  ('sender-login-maps', self._alias_config._sender_login_maps)])
+
     def _save_alias_tables(self, args):
-        self._which(self._getpostmap())
-        virtual_alias = self._alias_config.serialize(True, False)
-        sender_login_maps = self._alias_config.serialize(False, True)
         if not args.save:
+            self._get_map_writer().check()
             return self.list_aliases(args)
-        else:
-            fc = load_file_config()
-            with open(fc['virtual-alias'], 'w') as file:
-                file.write(virtual_alias)
-            with open(fc['sender-login-maps'], 'w') as file:
-                file.write(sender_login_maps)
-            self._exec_postmap(fc['virtual-alias'])
-            self._exec_postmap(fc['sender-login-maps'])
-            return 'Successfully saved.'
+        return self.save_alias_tables()
 
     def add_alias(self, args):
         if hasattr(args, 'comment'):
@@ -476,8 +2088,191 @@ class App(object):
         self._alias_config.del_virtual_alias_user(args.user)
         return self._save_alias_tables(args)
 
+    @staticmethod
+    def _open_input(args):
+        if args.file == '-':
+            return contextlib.nullcontext(sys.stdin)
+        return open(args.file)
+
+    def batch_aliases(self, args):
+        with self._open_input(args) as file:
+            results = self._alias_config.apply_batch(read_batch(file), atomic=args.strict)
+
+        out = []
+        for result in results:
+            operation = result.operation
+            words = ' '.join(str(v) for v in operation.args.values()) if operation.op != 'invalid' else ''
+            if result.error is None:
+                out.append('Line %s: ok: %s %s' % (operation.line_no, operation.op, words))
+            else:
+                out.append('Line %s: error: %s' % (operation.line_no, result.error))
+        failed = len([r for r in results if r.error is not None])
+        out.append('%s operations, %s failed.' % (len(results), failed))
+        if failed and args.strict:
+            out.append('No changes have been saved.')
+        else:
+            out.append(self._save_alias_tables(args))
+        return '\n'.join(out)
 
-def init_args_parser(parser, obj):
+    def resolve_aliases(self, args):
+        with self._open_input(args) as file:
+            addresses = [line.strip() for line in file if line.strip()]
+        out = []
+        for resolution in self._alias_config.resolve(addresses):
+            if args.json:
+                out.append(json.dumps(resolution._asdict()))
+            else:
+                out.append('\t'.join((resolution.address, ','.join(resolution.recipients),
+                                      ','.join(resolution.senders))))
+        return '\n'.join(out)
+
+    def export_tables(self, args):
+        # Exports the tables as they are in memory, through the daemon including its unsaved changes. The
+        # entries of each table are sorted by key, so import can merge them in one pass.
+        names = args.table or TABLE_NAMES
+        rows = (row for name in names for row in export_rows(name, self._table(name).sorted_records()))
+        return format_export(rows, args.format)
+
+    def import_tables(self, args):
+        # Merges the rows of each table straight into it while reading. The rows of a table have to follow
+        # each other and its entries have to be sorted by key, like export writes them.
+        tables = {}
+        out = []
+        try:
+            with self._open_input(args) as file:
+                rows = read_export(file, args.format)
+                for name, group in itertools.groupby(rows, key=lambda row: row.table):
+                    if args.table and name not in args.table:
+                        collections.deque(group, maxlen=0)
+                        continue
+                    if name in tables:
+                        raise ConfigError('%s: the rows of the table have to follow each other.' % name)
+                    table = tables[name] = self._table(name)
+                    table.begin()
+                    out.append(self._import_table(name, table, group, args.replace))
+        except Exception:
+            for table in tables.values():
+                table.rollback()
+            raise
+        for table in tables.values():
+            table.commit()
+        if not out:
+            return 'Nothing to import.'
+        if args.save:
+            self._get_map_writer().check()
+            out.append(self._save_tables(list(tables.items())))
+        return '\n'.join(out)
+
+    @staticmethod
+    def _import_table(name, table, rows, replace):
+        comments = {}
+
+        def entries():
+            for row in rows:
+                if row.key in EXPORT_COMMENT_KEYS.values():
+                    comments[row.key] = row.entry
+                else:
+                    yield row.key, row.entry
+
+        try:
+            added, changed, removed = table.merge(entries(), replace)
+        except ConfigError as e:
+            raise ConfigError('%s: %s' % (name, e))
+        for key in ('#', None):
+            if key in comments:
+                if key not in table:
+                    table[key] = comments[key]
+                    added += 1
+                elif not table._same_entry(table[key], comments[key]):
+                    comments[key].line_no = table[key].line_no
+                    table[key] = comments[key]
+                    changed += 1
+            elif replace and key in table:
+                del table[key]
+                removed += 1
+        return '%s: %s added, %s changed, %s removed.' % (name, added, changed, removed)
+
+    @staticmethod
+    def _read_table_file(path):
+        # A table as a plain dict, empty if the file doesn't exist
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            try:
+                return PostfixTableParser().parse(file)
+            except ParserError as e:
+                raise FactoryError('Error while parsing %s' % path) from e
+
+    def diff_tables(self, args):
+        # Patch from old to new, files of one table or directories with the table files named like the
+        # configured ones. Without new the current tables are the new version.
+        fc = self._load_file_config()
+        names = args.table or TABLE_NAMES
+        if os.path.isdir(args.old):
+            if args.new is not None and not os.path.isdir(args.new):
+                raise ConfigError('%s is a directory, %s is not.' % (args.old, args.new))
+            pairs = [(name, os.path.join(args.old, os.path.basename(fc[name])),
+                      os.path.join(args.new, os.path.basename(fc[name])) if args.new else None) for name in names]
+        elif len(names) != 1:
+            raise ConfigError('Comparing files needs exactly one --table.')
+        else:
+            pairs = [(names[0], args.old, args.new)]
+
+        def lines():
+            for name, old, new in pairs:
+                new = self._table(name) if new is None else self._read_table_file(new)
+                yield from format_patch(name, PostfixTable.diff_mappings(self._read_table_file(old), new))
+        return lines()
+
+    def apply_patch(self, args):
+        tables = {}
+        counts = {}
+        with self._open_input(args) as file:
+            ops = list(read_patch(file))
+        for op in ops:
+            if op.table not in tables:
+                tables[op.table] = self._table(op.table)
+                tables[op.table].begin()
+                counts[op.table] = 0
+        try:
+            for op in ops:
+                if tables[op.table].apply(op.op, op.key, op.entry):
+                    counts[op.table] += 1
+        except Exception:
+            for table in tables.values():
+                table.rollback()
+            raise
+        for table in tables.values():
+            table.commit()
+        if not ops:
+            return 'Nothing to apply.'
+        out = ['%s: %s of %s changes applied.' % (name, counts[name], len([o for o in ops if o.table == name]))
+               for name in TABLE_NAMES if name in tables]
+        if args.save:
+            self._get_map_writer().check()
+            out.append(self._save_tables([(name, tables[name]) for name in TABLE_NAMES if name in tables]))
+        return '\n'.join(out)
+
+    def check(self, args):
+        problems = self._alias_config.check(duplicates=not args.no_duplicates)
+        if not problems:
+            return 'No problems found.'
+        out = ['%s\t%s\t%s\t%s' % problem for problem in problems]
+        out.append('%s problems found.' % len(problems))
+        return '\n'.join(out)
+
+    def serve(self, args):
+        import daemon
+        server = daemon.Daemon(args.listen, args.delay, args.max_delay, args.socketmap)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 'Stopped.'
+
+
+def init_args_parser(parser, obj, argv=None):
+    # With argv only the commands it selects get their arguments, the others are just listed
     parser.set_defaults(**obj.get('defaults', {}))
     for a in obj.get('arguments', []):
         a = a.copy()
@@ -491,36 +2286,84 @@ def init_args_parser(parser, obj):
         parser.add_argument(name, **a)
 
     args_parser_from_list(parser, obj.get('commands', []), obj.get('commands-title', 'commands'),
-                          obj.get('commands-help', ''))
+                          obj.get('commands-help', ''), None if argv is None else _select_command(obj, argv))
+
 
+def _select_command(obj, argv):
+    # Returns the command name argv starts with after the options of obj and the arguments following it
+    takes_value = {o['name'] for o in obj.get('options', []) if o.get('action', 'store') == 'store'}
+    i = 0
+    while i < len(argv) and argv[i].startswith('-') and argv[i] != '--':
+        if argv[i] in takes_value:
+            i += 1
+        i += 1
+    if i >= len(argv) or argv[i] == '--':
+        return None
+    return argv[i], argv[i + 1:]
 
-def args_parser_from_list(parser, objects, kind, helptext=''):
+
+def args_parser_from_list(parser, objects, kind, helptext='', selected=None):
     if objects:
         sub = parser.add_subparsers(title=kind, required=True, dest=kind, help=helptext)
+        if selected is not None and selected[0] not in [o['name'] for o in objects]:
+            # Probably an abbreviated option or a typo, argparse has to see the whole tree to handle it
+            selected = None
         for o in objects:
             p = sub.add_parser(o['name'], help=o['help'])
-            init_args_parser(p, o)
+            if selected is None:
+                init_args_parser(p, o)
+            elif o['name'] == selected[0]:
+                init_args_parser(p, o, selected[1])
 
 
-def create_args_parser(cls):
+def create_args_parser(cls, argv=None):
     parser = argparse.ArgumentParser()
-    init_args_parser(parser, cls.main)
+    init_args_parser(parser, cls.main, argv)
     return parser
 
 
 def parse_args(cls, argv):
-    parser = create_args_parser(cls)
+    parser = create_args_parser(cls, argv[1:])
     return parser.parse_args(argv[1:])
 
 
 if __name__ == "__main__":
+    # Modules importing postfixhelper have to share this instance of it
+    sys.modules.setdefault('postfixhelper', sys.modules[__name__])
     args = parse_args(help.Help, sys.argv)
-    cfg = args.config_file if args.config_file else CONFIG
-    cf = load_file_config(cfg)
-    app = App()
-    action = getattr(app, args.action)
+    if args.timings or args.profile:
+        timings.TIMINGS.start(profile_file=args.profile)
     try:
-        print(action(args))
+        if args.socket and args.action != 'serve':
+            import daemon
+            print(daemon.request_from_args(args.socket, args))
+            sys.exit(0)
+        if args.no_cache:
+            PostfixTable.use_cache = False
+        if args.action in App.read_only_actions and not getattr(args, 'as_saved', False):
+            PostfixTable.load_comments = False
+        if args.multi_config:
+            import session
+            if args.config_file:
+                raise ConfigError('--config-file and --multi-config exclude each other.')
+            with timings.TIMINGS.phase('command', action=args.action, multi_config=True):
+                results = session.run_multi(session.expand_configs(args.multi_config), args, args.jobs)
+            sys.exit(1 if session.print_results(results) else 0)
+        cfg = args.config_file if args.config_file else CONFIG
+        cf = load_file_config(cfg)
+        app = App()
+        action = getattr(app, args.action)
+        with timings.TIMINGS.phase('command', action=args.action):
+            result = action(args)
+            if isinstance(result, types.GeneratorType):
+                for line in result:
+                    print(line)
+            else:
+                print(result)
     except Exception as e:
-        print(e.with_traceback(), file=sys.stderr)
-
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        summary = timings.TIMINGS.stop()
+        if summary is not None:
+            print(json.dumps(summary), file=sys.stderr)
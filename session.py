@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import os
+import sys
+import types
+import threading
+import contextlib
+import collections
+
+import help
+import config
+import postfixhelper
+
+__all__ = ['RWLock', 'Session', 'SessionPool', 'SessionApp', 'InstanceResult', 'expand_configs', 'run_multi',
+           'print_results']
+
+DEFAULT_JOBS = help.DEFAULT_JOBS
+# Actions which can't run for several configs at once
+SINGLE_CONFIG_ACTIONS = ('serve',)
+
+InstanceResult = collections.namedtuple('InstanceResult', 'config_file output error')
+
+
+class RWLock(object):
+    # Any number of readers or one writer. Waiting writers keep new readers out, so they don't starve. Only the
+    # writer may take the lock again, a reader taking read() again deadlocks once a writer is waiting.
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        # Thread holding the write lock and how often it took it
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        if self._writer == threading.get_ident():
+            yield
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers -= 1
+                self._writer = threading.get_ident()
+            self._writes += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writes -= 1
+                if not self._writes:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class Session(object):
+    # The config and tables of one config file, independent of the global ones in postfixhelper and of other
+    # sessions. Threads sharing a session use reading() and writing(), which hand out a PFAliasConfig on the
+    # session's tables.
+    def __init__(self, cfg):
+        if not isinstance(cfg, config.Config):
+            cfg = config.Config(filename=cfg)
+        self.config = cfg
+        self.file_config = config.FileConfig(cfg)
+        self.lock = RWLock()
+        self._tables = {}
+        self._tables_lock = threading.Lock()
+        self._writing = False
+
+    def table(self, name):
+        # Tables are loaded on first use, under a lock so that concurrent readers parse them only once
+        with self._tables_lock:
+            table = self._tables.get(name)
+            if table is None:
+                table = postfixhelper.PostfixTable(name, file_config=self.file_config)
+                len(table)
+                if self._writing:
+                    table.begin()
+                self._tables[name] = table
+        return table
+
+    def alias_config(self):
+        return postfixhelper.PFAliasConfig(self)
+
+    def app(self):
+        return postfixhelper.App(self)
+
+    def _stale_tables(self):
+        # Tables someone else saved since they were loaded. Tables with changes merge them when they are saved.
+        return [table for name, table in list(self._tables.items())
+                if not table.is_dirty() and table.changed_on_disk(self.file_config[name])]
+
+    def refresh(self):
+        for table in self._stale_tables():
+            table._initialize()
+
+    @contextlib.contextmanager
+    def reading(self):
+        if self._stale_tables():
+            with self.lock.write():
+                self.refresh()
+        with self.lock.read():
+            yield self.alias_config()
+
+    @contextlib.contextmanager
+    def writing(self):
+        # Changes are rolled back if the block raises. Saving them is up to the block, see save().
+        with self.lock.write():
+            self.refresh()
+            self._writing = True
+            for table in self._tables.values():
+                table.begin()
+            try:
+                yield self.alias_config()
+            except BaseException:
+                for table in self._tables.values():
+                    table.rollback()
+                raise
+            else:
+                for table in self._tables.values():
+                    table.commit()
+            finally:
+                self._writing = False
+
+    def save(self):
+        # Under the write lock, also when called within writing()
+        with self.lock.write():
+            app = self.app()
+            app._get_map_writer().check()
+            return app._save_tables([(name, self._tables[name]) for name in postfixhelper.TABLE_NAMES
+                                     if name in self._tables])
+
+
+class SessionPool(object):
+    # One session per config file for all threads, so unchanged tables are parsed once for all requests
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, config_file):
+        config_file = os.path.abspath(config_file)
+        with self._lock:
+            session = self._sessions.get(config_file)
+            if session is None:
+                session = Session(config_file)
+                self._sessions[config_file] = session
+        return session
+
+    def reading(self, config_file):
+        return self.session(config_file).reading()
+
+    def writing(self, config_file):
+        return self.session(config_file).writing()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SessionApp(postfixhelper.App):
+    # The input is read once by run_multi and handed to the app of every config. Lines the app reports,
+    # like the commands it ran, go to the output of its config instead of being mixed into stdout.
+    def __init__(self, session=None):
+        super().__init__(session)
+        self.reported = []
+
+    @staticmethod
+    def _open_input(args):
+        return contextlib.nullcontext(args.lines)
+
+    def _report(self, line):
+        self.reported.append(line)
+
+
+def expand_configs(patterns):
+    # Config files matching the glob patterns, in the order of the patterns and sorted within each
+    import glob
+    files = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        if not matches:
+            raise postfixhelper.ConfigError("No config file matches '%s'." % pattern)
+        files.update((os.path.abspath(match), None) for match in matches)
+    return list(files)
+
+
+def _run_action(config_file, args):
+    try:
+        app = SessionApp(Session(config_file))
+        result = getattr(app, args.action)(args)
+        if isinstance(result, types.GeneratorType):
+            result = '\n'.join(result)
+        return InstanceResult(config_file, '\n'.join(app.reported + [result]), None)
+    except Exception as e:
+        return InstanceResult(config_file, None, e)
+
+
+def run_multi(config_files, args, jobs=DEFAULT_JOBS):
+    # Runs args.action for every config file with a session of its own, jobs of them at once. Returns an
+    # InstanceResult per config file, in the same order. Errors don't stop the other configs.
+    import concurrent.futures
+    if args.action in SINGLE_CONFIG_ACTIONS:
+        raise postfixhelper.ConfigError("'%s' can't run for several configs at once." % args.action)
+    if getattr(args, 'file', None) is not None:
+        with postfixhelper.App._open_input(args) as file:
+            args.lines = list(file)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return list(executor.map(lambda config_file: _run_action(config_file, args), config_files))
+
+
+def print_results(results, out=None, err=None):
+    # Prints the output of every config under its name, errors to err. Returns the number of failed configs.
+    out = sys.stdout if out is None else out
+    err = sys.stderr if err is None else err
+    failed = 0
+    for result in results:
+        print('==> %s <==' % result.config_file, file=out)
+        if result.error is None:
+            print(result.output, file=out)
+        else:
+            failed += 1
+            print('==> %s <==\n%s' % (result.config_file, result.error), file=err)
+    if failed:
+        print('%s of %s configs failed.' % (failed, len(results)), file=err)
+    return failed
@@ -0,0 +1,51 @@
+import unittest
+import os
+import shutil
+import tempfile
+import importlib
+import postfixhelper
+from benchmarks import generate, run
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        importlib.reload(postfixhelper)
+
+    @staticmethod
+    def _keys(table):
+        # Without the header and footer comment entries
+        return [key for key in table if key not in (None, '#')]
+
+    def test_generate_tables(self):
+        config_file = generate.generate_tables(self.dir, 200, domains=3, aliases_per_inbox=4, deleted=0.1, seed=1)
+        ph = run._fresh(config_file)
+        aliases = ph.PostfixTable('virtual-alias')
+        deleted = [key for key in self._keys(aliases) if aliases[key].deleted]
+        self.assertEqual(len(self._keys(aliases)), 200)
+        self.assertTrue(0 < len(deleted) < 200)
+        self.assertEqual(len(self._keys(ph.PostfixTable('virtual-mailbox-users'))), 50)
+        self.assertEqual(len(self._keys(ph.PostfixTable('virtual-mailbox-domains'))), 3)
+        senders = ph.PostfixTable('sender-login-maps')
+        self.assertEqual({key: senders[key].value for key in self._keys(senders)},
+                         {key: aliases[key].value for key in self._keys(aliases)})
+
+    def test_run_compare(self):
+        results = run.run([50], repeat=1, memory=True, directory=self.dir)
+        self.assertEqual([r['operation'] for r in results['results']], ['startup'] + list(run.BENCHMARKS))
+        self.assertGreater(results['results'][0]['seconds'], 0)
+        for result in results['results'][1:]:
+            self.assertGreater(result['peak_bytes'], 0)
+            self.assertTrue(os.path.exists(os.path.join(self.dir, '50', 'virtual-alias')))
+        slower = {'results': [dict(r, seconds=r['seconds'] * 2) for r in results['results']]}
+        lines, regression = run.compare(results, slower)
+        self.assertTrue(regression)
+        self.assertEqual(len(lines), len(run.BENCHMARKS) + 1)
+        self.assertFalse(run.compare(results, results)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import os
+import shutil
+import tempfile
+import cache
+
+
+class TestSnapshotCache(unittest.TestCase):
+    RECORDS = [('key', 'value', ['comment'], 1, False), ('#', None, [], 0, False)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.table = os.path.join(self.dir, 'table')
+        with open(self.table, 'w') as file:
+            file.write('key value\n')
+        self.cache = cache.SnapshotCache(os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _snapshots(self):
+        return os.listdir(self.cache.directory)
+
+    def test_store_load(self):
+        self.assertIsNone(self.cache.load(self.table))
+        self.assertTrue(self.cache.store(self.table, self.RECORDS, self.cache.file_id(self.table)))
+        self.assertEqual(self.cache.load(self.table), self.RECORDS)
+
+    def test_changed_file(self):
+        self.cache.store(self.table, self.RECORDS, self.cache.file_id(self.table))
+        with open(self.table, 'a') as file:
+            file.write('key2 value\n')
+        self.assertIsNone(self.cache.load(self.table))
+        # The stale snapshot is evicted
+        self.assertEqual(self._snapshots(), [])
+
+    def test_same_stat_different_content(self):
+        self.cache.store(self.table, self.RECORDS, self.cache.file_id(self.table))
+        stat = os.stat(self.table)
+        with open(self.table, 'w') as file:
+            file.write('key other\n')
+        os.utime(self.table, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIsNone(self.cache.load(self.table))
+
+    def test_file_changed_while_parsing(self):
+        file_id = self.cache.file_id(self.table)
+        with open(self.table, 'a') as file:
+            file.write('key2 value\n')
+        self.assertFalse(self.cache.store(self.table, self.RECORDS, file_id))
+        self.assertIsNone(self.cache.load(self.table))
+
+    def test_evict_removed_table(self):
+        self.cache.store(self.table, self.RECORDS, self.cache.file_id(self.table))
+        os.remove(self.table)
+        self.cache.evict()
+        self.assertEqual(self._snapshots(), [])
+
+    def test_corrupt_snapshot(self):
+        self.cache.store(self.table, self.RECORDS, self.cache.file_id(self.table))
+        path = os.path.join(self.cache.directory, self._snapshots()[0])
+        with open(path, 'wb') as file:
+            file.write(b'garbage')
+        self.assertIsNone(self.cache.load(self.table))
@@ -0,0 +1,46 @@
+import unittest
+import os
+import tempfile
+import cdb
+
+
+class TestCdb(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_hash(self):
+        self.assertEqual(cdb.cdb_hash(b''), 5381)
+        self.assertEqual(cdb.cdb_hash(b'a'), ((5381 << 5) + 5381) ^ ord('a'))
+
+    def test_write_read(self):
+        entries = {'key%s@domain' % i: 'value%s' % (i % 7) for i in range(1000)}
+        with cdb.CdbWriter(self.path) as writer:
+            for key, value in entries.items():
+                writer.add(key, value)
+        reader = cdb.CdbReader(self.path)
+        for key, value in entries.items():
+            self.assertEqual(reader.get(key), value)
+        self.assertIsNone(reader.get('missing'))
+
+    def test_empty(self):
+        cdb.CdbWriter(self.path).close()
+        self.assertEqual(os.path.getsize(self.path), cdb.HEADER_SIZE)
+        self.assertIsNone(cdb.CdbReader(self.path).get('key'))
+
+    def test_abort(self):
+        with open(self.path, 'w') as file:
+            file.write('old')
+        try:
+            with cdb.CdbWriter(self.path) as writer:
+                writer.add('key', 'value')
+                raise ValueError()
+        except ValueError:
+            pass
+        with open(self.path) as file:
+            self.assertEqual(file.read(), 'old')
+        self.assertEqual([f for f in os.listdir(os.path.dirname(self.path)) if f.endswith('.tmp')
+                          and f.startswith(os.path.basename(self.path))], [])
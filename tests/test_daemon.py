@@ -0,0 +1,101 @@
+import unittest
+import importlib
+import tempfile
+import threading
+import shutil
+import json
+import time
+import os
+import postfixhelper
+import daemon
+from tests.test_pfhelper import load_empty_config, unload_config, POSTMAP_STUB
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        load_empty_config()
+        importlib.reload(daemon)
+        postfixhelper.CONFIG['postmap'] = os.path.abspath(POSTMAP_STUB)
+        postfixhelper.PostfixTable('virtual-mailbox-users')['testsender'] = postfixhelper.TableEntry()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'socket')
+        self.daemon = daemon.Daemon(self.path, delay=0.2, max_delay=1)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        while not os.path.exists(self.path):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        fc = postfixhelper.load_file_config()
+        for name in ('virtual-alias', 'sender-login-maps'):
+            if os.path.exists(fc[name] + '.log'):
+                os.remove(fc[name] + '.log')
+        shutil.rmtree(self.dir)
+        unload_config()
+
+    def _postmap_calls(self, name):
+        path = postfixhelper.load_file_config()[name] + '.log'
+        if not os.path.exists(path):
+            return []
+        with open(path) as log:
+            return [json.loads(line) for line in log]
+
+    def test_coalesced_save(self):
+        for i in range(5):
+            out = daemon.request(self.path, 'add_alias', {'alias': 'alias%s' % i, 'user': 'testsender',
+                                                          'comment': '', 'save': True})
+            self.assertEqual(out, 'Changes applied, the tables will be saved shortly.')
+        self.assertEqual(self._postmap_calls('virtual-alias'), [])
+        time.sleep(0.5)
+        self.assertEqual(len(self._postmap_calls('virtual-alias')), 1)
+        self.assertEqual(len(self._postmap_calls('sender-login-maps')), 1)
+
+        out = daemon.request(self.path, 'list_aliases', {})
+        self.assertIn('alias4', out)
+        out = daemon.request(self.path, 'list_aliases', {'filter_prefix': 'alias', 'limit': 2, 'stream': True})
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ['alias0', 'alias1'])
+
+    def test_dry_run(self):
+        import lookup
+        out = daemon.request(self.path, 'add_alias', {'alias': 'dry@x', 'user': 'testsender', 'comment': '',
+                                                      'save': False})
+        self.assertIn('dry@x', out)
+        # The preview is undone, neither lookups nor the next save see it
+        self.assertEqual(lookup.SocketmapServer().lookup('virtual-alias dry@x'), 'NOTFOUND ')
+        daemon.request(self.path, 'add_alias', {'alias': 'real@x', 'user': 'testsender', 'comment': '',
+                                                'save': True})
+        self.daemon.flush()
+        with open(postfixhelper.load_file_config()['virtual-alias']) as file:
+            data = file.read()
+        self.assertIn('real@x', data)
+        self.assertNotIn('dry@x', data)
+
+    def test_errors(self):
+        self.assertRaises(daemon.DaemonError, lambda: daemon.request(self.path, 'add_alias', {
+            'alias': 'alias', 'user': 'nobody', 'comment': '', 'save': True}))
+        self.assertRaises(daemon.DaemonError, lambda: daemon.request(self.path, 'serve', {}))
+        self.assertRaises(daemon.DaemonError, lambda: daemon.request(self.dir + '/nothing', 'list_aliases', {}))
+        self.assertEqual(self.daemon.handle({'action': 'list_aliases', 'args': ['x']})['ok'], False)
+        self.assertEqual(self.daemon.handle({'action': 'list_aliases', 'args': {}})['ok'], True)
+
+    def test_failed_save(self):
+        postfixhelper.CONFIG['postmap'] = os.path.join(self.dir, 'missing')
+        daemon.request(self.path, 'add_alias', {'alias': 'alias1', 'user': 'testsender', 'comment': '',
+                                                'save': True})
+        time.sleep(0.5)
+        response = self.daemon.handle({'action': 'list_aliases', 'args': {}})
+        self.assertTrue(response['ok'])
+        self.assertIn('Saving the tables failed', response['save_error'])
+        # The save is tried again
+        postfixhelper.CONFIG['postmap'] = os.path.abspath(POSTMAP_STUB)
+        time.sleep(1)
+        self.assertNotIn('save_error', self.daemon.handle({'action': 'list_aliases', 'args': {}}))
+        self.assertEqual(len(self._postmap_calls('virtual-alias')), 1)
+
+    def test_batch(self):
+        args = {'lines': ['add alias1 testsender\n', 'add alias2 nobody\n'], 'strict': True, 'save': True}
+        out = daemon.request(self.path, 'batch_aliases', args)
+        self.assertIn('No changes have been saved.', out)
+        self.assertNotIn('alias1', daemon.request(self.path, 'list_aliases', {}))
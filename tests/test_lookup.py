@@ -0,0 +1,87 @@
+import unittest
+import tempfile
+import shutil
+import socket
+import os
+import postfixhelper
+import lookup
+from tests.test_pfhelper import load_empty_config, unload_config
+
+
+class TestSocketmapServer(unittest.TestCase):
+    def setUp(self):
+        load_empty_config()
+        self.aliases = postfixhelper.PostfixTable('virtual-alias')
+        self.aliases['alias@domain'] = postfixhelper.TableEntry('user@domain', [], 1)
+        self.aliases['deleted@domain'] = postfixhelper.TableEntry('user@domain', [], 2, True)
+        self.server = lookup.SocketmapServer({'virtual-alias': self.aliases})
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+        unload_config()
+
+    def test_lookup(self):
+        self.assertEqual(self.server.lookup('virtual-alias alias@domain'), 'OK user@domain')
+        self.assertEqual(self.server.lookup('virtual-alias deleted@domain'), 'NOTFOUND ')
+        self.assertEqual(self.server.lookup('virtual-alias #'), 'NOTFOUND ')
+        self.assertEqual(self.server.lookup('virtual-alias unknown@domain'), 'NOTFOUND ')
+        self.assertTrue(self.server.lookup('other alias@domain').startswith('PERM '))
+
+    def test_lookup_case(self):
+        # Like postmap and Postfix, keys and queries are folded to lower case
+        self.aliases['Info@Example.com'] = postfixhelper.TableEntry('user@domain', [], 3)
+        self.assertEqual(self.server.lookup('virtual-alias info@example.com'), 'OK user@domain')
+        self.assertEqual(self.server.lookup('virtual-alias INFO@example.COM'), 'OK user@domain')
+        self.assertEqual(self.server.lookup('virtual-alias Alias@Domain'), 'OK user@domain')
+        self.aliases['info@example.com'] = postfixhelper.TableEntry('other@domain', [], 4)
+        self.assertEqual(self.server.lookup('virtual-alias info@example.com'), 'OK user@domain')
+        del self.aliases['Info@Example.com']
+        self.assertEqual(self.server.lookup('virtual-alias Info@Example.com'), 'OK other@domain')
+        del self.aliases['info@example.com']
+        self.assertEqual(self.server.lookup('virtual-alias info@example.com'), 'NOTFOUND ')
+
+    def test_lock(self):
+        import threading
+        lock = threading.Lock()
+        server = lookup.SocketmapServer({'virtual-alias': self.aliases}, lock=lock)
+        replies = []
+        with lock:
+            thread = threading.Thread(target=lambda: replies.append(server.lookup('virtual-alias new@domain')))
+            thread.start()
+            thread.join(0.05)
+            # The lookup waits until the change is complete
+            self.assertEqual(replies, [])
+            self.aliases['new@domain'] = postfixhelper.TableEntry('other@domain', [], 3)
+        thread.join()
+        self.assertEqual(replies, ['OK other@domain'])
+
+    def test_netstring(self):
+        self.assertEqual(lookup.netstring('OK user'), b'7:OK user,')
+        self.assertEqual(lookup.netstring(''), b'0:,')
+
+    @staticmethod
+    def _read_netstring(stream):
+        length = b''
+        while not length.endswith(b':'):
+            length += stream.read(1)
+        return stream.read(int(length[:-1]) + 1)[:-1].decode()
+
+    def test_protocol(self):
+        path = os.path.join(self.dir, 'socket')
+        self.server.start_thread('unix:' + path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            with sock.makefile('rwb') as stream:
+                stream.write(lookup.netstring('virtual-alias alias@domain'))
+                stream.write(lookup.netstring('virtual-alias new@domain'))
+                stream.flush()
+                self.assertEqual(self._read_netstring(stream), 'OK user@domain')
+                self.assertEqual(self._read_netstring(stream), 'NOTFOUND ')
+
+                # Changes are visible immediately
+                self.aliases['new@domain'] = postfixhelper.TableEntry('other@domain', [], 3)
+                stream.write(lookup.netstring('virtual-alias new@domain'))
+                stream.flush()
+                self.assertEqual(self._read_netstring(stream), 'OK other@domain')
@@ -1,9 +1,18 @@
 import unittest
+import argparse
+import subprocess
+import contextlib
+import types
+import io
+import json
+import tempfile
+import shutil
 import importlib
 import textwrap
 import sys
 import os
 import postfixhelper
+import cdb
 import help
 
 DATA = """#A file comment
@@ -41,6 +50,7 @@ alias3@domain           user2@domain
 NO_COMMENT = "abcde fghij"
 
 EMPTY_CONFIG = './tests/testdata/emptyconfig.yaml'
+POSTMAP_STUB = './tests/testdata/postmap'
 
 
 def load_test_config():
@@ -50,8 +60,9 @@ def load_test_config():
 def unload_config():
     if postfixhelper.CONFIG and postfixhelper.CONFIG.filename == EMPTY_CONFIG:
         for f in postfixhelper.FILE_CONFIG.values():
-            if os.path.exists(f):
-                os.remove(f)
+            for path in (f, f + '.lock'):
+                if os.path.exists(path):
+                    os.remove(path)
 
     # Since there are module an class level variables we have to reload the whole module
     # It's a bit messy but ¯\_(ツ)_/¯
@@ -87,6 +98,146 @@ class TestPostfixTableParser(unittest.TestCase):
         self.assertEqual(data['abcde'], postfixhelper.TableEntry('fghij', [], 1))
         self.assertRaises(KeyError, lambda: data[None])
 
+    def test_parse_file_object(self):
+        data = postfixhelper.PostfixTableParser().parse(io.StringIO(DATA))
+        self.assertEqual(data, postfixhelper.PostfixTableParser().parse(DATA))
+
+    def test_iter_parse_streams(self):
+        consumed = []
+
+        def lines():
+            for line in DATA.splitlines(keepends=True):
+                consumed.append(line)
+                yield line
+
+        records = postfixhelper.PostfixTableParser().iter_parse(lines())
+        self.assertEqual(next(records), ('HEADER', '#', None, ['A file comment'], 0))
+        self.assertEqual(next(records), ('ENTRY', 'alias1@domain', 'user1@domain', ['alias comment'], 4))
+        # Only the lines up to the first entry have been read
+        self.assertEqual(len(consumed), 4)
+        self.assertEqual(list(records)[-1], ('FOOTER', None, None, ['comment at the end'], 13))
+
+    def test_lazy_comments(self):
+        data = postfixhelper.PostfixTableParser().parse(DATA)
+        entry = data['alias1@domain']
+        self.assertIsInstance(entry.lazy_comment, postfixhelper.LazyComment)
+        self.assertEqual(entry.copy().lazy_comment, entry.lazy_comment)
+        self.assertEqual(entry.comment, ['alias comment'])
+        self.assertEqual(entry.lazy_comment, ['alias comment'])
+        self.assertEqual(entry.raw_comment, ['# alias comment'])
+        data = postfixhelper.PostfixTableParser().parse(DATA, comments=False)
+        self.assertEqual([key for key, entry in data.items() if entry.comment], [])
+        self.assertEqual(data['alias3@domain'], postfixhelper.TableEntry('user2@domain', [], 11))
+
+
+class TestTableEntry(unittest.TestCase):
+    def test_slots(self):
+        entry = postfixhelper.TableEntry('value')
+        self.assertRaises(AttributeError, lambda: entry.__dict__)
+        self.assertIs(entry.comment, postfixhelper.TableEntry('other', []).comment)
+        self.assertEqual(entry, postfixhelper.TableEntry('value', [], 0))
+
+
+class TestValuePool(unittest.TestCase):
+    def test_intern(self):
+        pool = postfixhelper.ValuePool()
+        value_id = pool.intern('user@domain')
+        self.assertEqual(pool.intern(''.join(['user', '@domain'])), value_id)
+        self.assertEqual(pool.value(value_id), 'user@domain')
+        self.assertEqual(pool.lookup(None), 0)
+        self.assertIsNone(pool.lookup('unknown'))
+
+    def test_release(self):
+        pool = postfixhelper.ValuePool()
+        value_id = pool.intern('user@domain')
+        pool.intern('user@domain')
+        pool.release(value_id)
+        self.assertEqual(pool.lookup('user@domain'), value_id)
+        pool.release(value_id)
+        self.assertIsNone(pool.lookup('user@domain'))
+        self.assertEqual(len(pool), 1)
+        # The id is reused
+        self.assertEqual(pool.intern('other'), value_id)
+
+    def test_shared_values(self):
+        data = postfixhelper.PostfixTableParser().parse(DATA)
+        self.assertIs(data['alias1@domain'].value, data['alias2@domain'].value)
+
+
+class TestColumnarTable(unittest.TestCase):
+    def setUp(self):
+        self.data = postfixhelper.PostfixTableParser().parse(DATA)
+        self.pool = postfixhelper.ValuePool()
+        self.table = postfixhelper.ColumnarTable(self.pool)
+        for key, entry in self.data.items():
+            self.table[key] = entry
+
+    def test_read(self):
+        self.assertEqual(list(self.table), list(self.data))
+        self.assertEqual(dict(self.table), self.data)
+
+    def test_modify(self):
+        self.table['alias1@domain'].deleted = True
+        self.table['alias3@domain'] = postfixhelper.TableEntry('user3@domain', [], 20)
+        del self.table['Multiline']
+        self.assertEqual(self.table['alias1@domain'],
+                         postfixhelper.TableEntry('user1@domain', ['alias comment'], 4, True))
+        self.assertEqual(self.table['alias3@domain'], postfixhelper.TableEntry('user3@domain', [], 20))
+        self.assertNotIn('Multiline', self.table)
+        # Values no row holds any more are dropped
+        self.table['alias3@domain'].value = 'user4@domain'
+        self.assertIsNone(self.table._pool.lookup('user3@domain'))
+        self.assertEqual(len(self.table), len(self.data) - 1)
+
+    def test_shared_pool(self):
+        other = postfixhelper.ColumnarTable(self.pool)
+        other['alias@domain'] = postfixhelper.TableEntry('user1@domain', [], 1)
+        # Both tables hold the same id
+        self.assertEqual(other._values[0], self.table._values[self.table._rows['alias1@domain']])
+        self.assertEqual(len(self.pool), 4)
+        del self.table
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(other['alias@domain'].value, 'user1@domain')
+
+
+class TestMappedTable(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as file:
+            file.write(DATA)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read(self):
+        data = postfixhelper.MappedTable(self.path)
+        self.assertEqual(list(data), list(postfixhelper.PostfixTableParser().parse(DATA)))
+        self.assertEqual(dict(data), postfixhelper.PostfixTableParser().parse(DATA))
+
+    def test_lazy_decode(self):
+        data = postfixhelper.MappedTable(self.path)
+        self.assertIn('alias3@domain', data)
+        self.assertIsInstance(data._index['alias3@domain'], tuple)
+        self.assertEqual(data['alias3@domain'], postfixhelper.TableEntry('user2@domain', ['A comment'], 11))
+        self.assertIsInstance(data._index['alias3@domain'], postfixhelper.TableEntry)
+
+    def test_modify(self):
+        data = postfixhelper.MappedTable(self.path)
+        data['new'] = postfixhelper.TableEntry('value', [], 99)
+        del data['alias1@domain']
+        self.assertNotIn('alias1@domain', data)
+        self.assertEqual(data['new'].value, 'value')
+
+    def test_empty_file(self):
+        with open(self.path, 'w'):
+            pass
+        self.assertEqual(dict(postfixhelper.MappedTable(self.path)), postfixhelper.PostfixTableParser().parse(''))
+
+    def test_syntax_error(self):
+        with open(self.path, 'w') as file:
+            file.write(FAULTY_DATA1)
+        self.assertRaises(postfixhelper.ParserError, lambda: postfixhelper.MappedTable(self.path))
+
 
 class TestPFConfigurationFactory(unittest.TestCase):
     def setUp(self):
@@ -102,6 +253,39 @@ class TestPFConfigurationFactory(unittest.TestCase):
         self.assertIsNotNone(alias.get_alias('alias@localdomain').sender.value)
 
 
+class TestTableSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        load_test_config()
+        postfixhelper.CONFIG['cache-dir'] = self.dir
+
+    def tearDown(self):
+        unload_config()
+        shutil.rmtree(self.dir)
+
+    def test_snapshot_used(self):
+        table = postfixhelper.PostfixTable('virtual-alias')
+        expected = dict(table)
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+
+        del table._mapping
+        table.parser = None   # Parsing again would fail
+        self.assertEqual(dict(table), expected)
+
+    def test_without_comments(self):
+        postfixhelper.PostfixTable.load_comments = False
+        table = postfixhelper.PostfixTable('virtual-alias')
+        self.assertEqual(table['#'].comment, ())
+        self.assertEqual(table['testalias'].value, 'testsender')
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertRaises(postfixhelper.ConfigError, table.serialize)
+
+    def test_no_cache(self):
+        postfixhelper.PostfixTable.use_cache = False
+        dict(postfixhelper.PostfixTable('virtual-alias'))
+        self.assertEqual(os.listdir(self.dir), [])
+
+
 class TestPFAlias(unittest.TestCase):
     @staticmethod
     def create_pf_alias():
@@ -140,6 +324,138 @@ class TestPFAlias(unittest.TestCase):
         self.assertEqual(expected.sender, a.sender)
         self.assertEqual(expected.inbox, a.inbox)
 
+    def test_user_aliases(self):
+        self.alias.add_alias('testalias1@localdomain', 'testuser@localdomain')
+        self.alias.add_alias('testalias2@localdomain', 'testuser@localdomain', sender_login_maps=False)
+        aliases = self.alias.get_user_aliases('testuser@localdomain')
+        self.assertEqual([a.alias for a in aliases], ['testalias1@localdomain', 'testalias2@localdomain'])
+        self.alias.del_virtual_alias_user('testuser@localdomain')
+        self.alias.del_sender_login_maps_user('testuser@localdomain')
+        self.assertEqual(self.alias.get_user_aliases('testuser@localdomain'), [])
+
+    def test_iter_aliases(self):
+        va = self.alias._virtual_alias
+        slm = self.alias._sender_login_maps
+        for i, (alias, user) in enumerate([('b@one', 'u2'), ('a@one', 'u1'), ('c@two', 'u1'), ('d@one', 'u1')]):
+            va[alias] = postfixhelper.TableEntry(user, [], i + 1)
+            slm[alias] = postfixhelper.TableEntry(user, [], i + 1)
+        slm['e@two'] = postfixhelper.TableEntry('u1', [], 1)
+        va.del_entry('d@one', comment_out=True)
+        expected = [a.alias for a in self.alias.get_alias_list(True, True) if a.alias not in ('#', None)]
+        self.assertEqual(expected, ['e@two', 'a@one', 'c@two', 'd@one', 'b@one'])
+        self.assertEqual([a.alias for a in self.alias.iter_aliases()], expected)
+        self.assertEqual([a.alias for a in self.alias.iter_aliases(offset=1, limit=2)], expected[1:3])
+        self.assertEqual([a.alias for a in self.alias.iter_aliases(domain='one')], ['a@one', 'd@one', 'b@one'])
+        self.assertEqual([a.alias for a in self.alias.iter_aliases(user='u1', domain='two')], ['e@two', 'c@two'])
+        self.assertEqual([a.alias for a in self.alias.iter_aliases(prefix='d', user='u1')], ['d@one'])
+        self.assertEqual([a.alias for a in self.alias.iter_aliases(prefix='x')], [])
+
+    def test_batch(self):
+        lines = [
+            'add testalias1@localdomain testuser@localdomain a comment',
+            '{"op": "add", "alias": "testalias2@localdomain", "user": "testuser@localdomain"}',
+            '',
+            'add testalias3@localdomain nonexisting_user@localdomain',
+            'del testalias1@localdomain',
+            'del testalias1@localdomain',
+            'del',
+            'rename a b',
+            '{"op": "del", "alias": "testalias2@localdomain", "comment_out": true}',
+            '{broken',
+            '{"op": "add", "alias": ["x"], "user": "testuser@localdomain"}',
+            '{"op": ["add"]}',
+            '{"op": "del", "alias": "testalias3@localdomain", "comment_out": "yes"}',
+        ]
+        results = self.alias.apply_batch(postfixhelper.read_batch(lines))
+        self.assertEqual([r.operation.line_no for r in results], [1, 2, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13])
+        self.assertEqual([r.error is None for r in results], [True, True, False, True, False, False, False, True,
+                                                              False, False, False, False])
+        self.assertEqual(results[-1].error, "JSON arguments must be strings, 'comment_out' a boolean.")
+        self.assertNotIn('testalias1@localdomain', self.alias._virtual_alias)
+        self.assertTrue(self.alias._virtual_alias['testalias2@localdomain'].deleted)
+
+    def test_batch_atomic(self):
+        self.alias.add_alias('testalias@localdomain', 'testuser@localdomain')
+        lines = [
+            'add testalias1@localdomain testuser@localdomain',
+            'del testalias@localdomain',
+            'add testalias2@localdomain nonexisting_user@localdomain',
+        ]
+        self.alias.apply_batch(postfixhelper.read_batch(lines), atomic=True)
+        self.assertNotIn('testalias1@localdomain', self.alias._virtual_alias)
+        self.assertIn('testalias@localdomain', self.alias._virtual_alias)
+        self.assertEqual(self.alias._virtual_alias.keys_for('testuser@localdomain'), ['testalias@localdomain'])
+
+        # Other errors undo the changes and close the journals as well
+        def operations():
+            yield from postfixhelper.read_batch(lines[:1])
+            raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, self.alias.apply_batch, operations(), atomic=True)
+        self.assertNotIn('testalias1@localdomain', self.alias._virtual_alias)
+        self.assertFalse(self.alias._virtual_alias._journals)
+        self.assertFalse(self.alias._sender_login_maps._journals)
+
+    def test_resolve(self):
+        va = self.alias._virtual_alias
+        va['team@localdomain'] = postfixhelper.TableEntry('a@localdomain,b@localdomain', [], 1)
+        va['a@localdomain'] = postfixhelper.TableEntry('testuser@localdomain', [], 2)
+        va['b@localdomain'] = postfixhelper.TableEntry('b@localdomain,a@localdomain', [], 3)
+        va['@otherdomain'] = postfixhelper.TableEntry('team@localdomain', [], 4)
+        va['loop1@localdomain'] = postfixhelper.TableEntry('loop2@localdomain', [], 5)
+        va['loop2@localdomain'] = postfixhelper.TableEntry('loop1@localdomain', [], 6)
+        va['gone@localdomain'] = postfixhelper.TableEntry('a@localdomain', [], 7, True)
+        self.alias._sender_login_maps['team@localdomain'] = postfixhelper.TableEntry('a,b', [], 1)
+        addresses = ['team@localdomain', 'x@otherdomain', 'nobody@localdomain', 'loop1@localdomain',
+                     'gone@localdomain']
+        result = {r.address: (r.recipients, r.senders) for r in self.alias.resolve(addresses)}
+        self.assertEqual(result['team@localdomain'],
+                         (['testuser@localdomain', 'b@localdomain'], ['a', 'b']))
+        self.assertEqual(result['x@otherdomain'], (['testuser@localdomain', 'b@localdomain'], []))
+        self.assertEqual(result['nobody@localdomain'], (['nobody@localdomain'], []))
+        self.assertEqual(result['loop1@localdomain'], (['loop1@localdomain'], []))
+        self.assertEqual(result['gone@localdomain'], (['gone@localdomain'], []))
+
+    def test_resolve_order(self):
+        va = self.alias._virtual_alias
+        va['loop1@localdomain'] = postfixhelper.TableEntry('loop2@localdomain', [], 1)
+        va['loop2@localdomain'] = postfixhelper.TableEntry('loop1@localdomain,testuser@localdomain', [], 2)
+        va['list@localdomain'] = postfixhelper.TableEntry('loop2@localdomain', [], 3)
+        addresses = ['loop1@localdomain', 'loop2@localdomain', 'list@localdomain']
+        expected = {
+            'loop1@localdomain': ['loop1@localdomain', 'testuser@localdomain'],
+            'loop2@localdomain': ['loop2@localdomain', 'testuser@localdomain'],
+            'list@localdomain': ['loop2@localdomain', 'testuser@localdomain'],
+        }
+        # Every address resolves the same, whichever of the loop was resolved first
+        for batch in (addresses, addresses[::-1]):
+            result = {r.address: r.recipients for r in self.alias.resolve(batch)}
+            self.assertEqual(result, expected)
+        self.alias.resolve_depth_limit = 1
+        for batch in (addresses, addresses[::-1]):
+            result = {r.address: r.recipients for r in self.alias.resolve(batch)}
+            self.assertEqual(result['loop1@localdomain'], ['loop2@localdomain'])
+            self.assertEqual(result['list@localdomain'], ['loop2@localdomain'])
+
+    def test_check(self):
+        with open(postfixhelper.load_file_config()['virtual-alias'], 'w') as file:
+            file.write('\nloop1@localdomain loop2@localdomain\nloop2@localdomain loop3@localdomain\n'
+                       'loop3@localdomain loop1@localdomain\nself@localdomain self@localdomain,x@external\n'
+                       'bad@localdomain missing@localdomain\nloop1@localdomain loop2@localdomain\n'
+                       'catch@localdomain x@catchall\n@catchall testuser@localdomain\n')
+        postfixhelper.PostfixTable('virtual-mailbox-domains')['localdomain'] = postfixhelper.TableEntry('x')
+        self.alias._sender_login_maps['orphan@localdomain'] = postfixhelper.TableEntry('testuser@localdomain')
+        self.alias._sender_login_maps['self@localdomain'] = postfixhelper.TableEntry('testuser@localdomain,x')
+        problems = self.alias.check()
+        self.assertEqual(sorted(problems), sorted([
+            postfixhelper.Problem('duplicate', 'virtual-alias', 'loop1@localdomain', 'line 7 repeats line 2'),
+            postfixhelper.Problem('dangling', 'virtual-alias', 'bad@localdomain',
+                                  "target 'missing@localdomain' is neither a user nor an alias"),
+            postfixhelper.Problem('orphan', 'sender-login-maps', 'orphan@localdomain', 'no entry in virtual-alias'),
+            postfixhelper.Problem('dangling', 'sender-login-maps', 'self@localdomain', "sender 'x' is not a user"),
+            postfixhelper.Problem('loop', 'virtual-alias', 'loop1@localdomain',
+                                  'loop1@localdomain -> loop2@localdomain -> loop3@localdomain -> loop1@localdomain'),
+        ]))
+
     def test_alias_without_user(self):
         self.assertRaises(postfixhelper.ConfigError, lambda: self.alias.add_alias('testalias@localdomain',
                                                                                   'nonexisting_user@localdomain'))
@@ -193,6 +509,144 @@ class TestPostfixTable(unittest.TestCase):
         # The other table must not
         self.assertRaises(KeyError, lambda: b['testvar1'])
 
+    def test_reverse_index(self):
+        table = postfixhelper.PostfixTable('virtual-alias')
+        table['a1'] = postfixhelper.TableEntry('user1', [], 1)
+        table['a2'] = postfixhelper.TableEntry('user1', [], 2)
+        self.assertEqual(table.keys_for('user1'), ['a1', 'a2'])
+        table['a3'] = postfixhelper.TableEntry('user1', [], 3)
+        table['a1'] = postfixhelper.TableEntry('user2', [], 1)
+        del table['a2']
+        table.del_entry('a3', comment_out=True)
+        self.assertEqual(table.keys_for('user1'), [])
+        self.assertEqual(table.keys_for('user1', include_deleted=True), ['a3'])
+        self.assertEqual(table.keys_for('user2'), ['a1'])
+        self.assertEqual(table.keys_for('unknown'), [])
+
+    def test_key_indexes(self):
+        table = postfixhelper.PostfixTable('virtual-alias')
+        table['a1@Example.org'] = postfixhelper.TableEntry('user1', [], 1)
+        table['b1@example.org'] = postfixhelper.TableEntry('user1', [], 2)
+        table['@example.org'] = postfixhelper.TableEntry('user2', [], 3)
+        table['a2@other.org'] = postfixhelper.TableEntry('user2', [], 4)
+        self.assertEqual(table.keys_in_domain('example.ORG'), ['a1@Example.org', 'b1@example.org', '@example.org'])
+        self.assertEqual(table.keys_with_prefix('a'), ['a1@Example.org', 'a2@other.org'])
+        table['a3'] = postfixhelper.TableEntry('user3', [], 5)
+        table['a1@Example.org'] = postfixhelper.TableEntry('user3', [], 1)
+        del table['b1@example.org']
+        self.assertEqual(table.keys_in_domain('example.org'), ['a1@Example.org', '@example.org'])
+        self.assertEqual(table.keys_in_domain(''), ['a3'])
+        self.assertEqual(table.keys_with_prefix('a'), ['a1@Example.org', 'a2@other.org', 'a3'])
+        self.assertEqual(table.keys_with_prefix('b'), [])
+        self.assertEqual(table.keys_with_prefix(''), ['@example.org', 'a1@Example.org', 'a2@other.org', 'a3'])
+
+    def test_merge(self):
+        table = postfixhelper.PostfixTable('virtual-alias')
+        for i, key in enumerate(['a', 'c', 'e']):
+            table[key] = postfixhelper.TableEntry('user', [], i + 1)
+        table.clear_changes()
+        entries = [('b', postfixhelper.TableEntry('user', [], sys.maxsize)),
+                   ('c', postfixhelper.TableEntry('user', [], sys.maxsize)),
+                   ('e', postfixhelper.TableEntry('other', ['note'], sys.maxsize))]
+        self.assertEqual(table.merge(entries), (1, 1, 0))
+        self.assertEqual(table['e'], postfixhelper.TableEntry('other', ['note'], 3))
+        self.assertEqual(table.keys_with_prefix(''), ['a', 'b', 'c', 'e'])
+        self.assertEqual(table.delta(), ({'b': 'user', 'e': 'other'}, []))
+        self.assertEqual(table.merge(entries[1:], replace=True), (0, 0, 2))
+        self.assertEqual(sorted(k for k in table if k not in ('#', None)), ['c', 'e'])
+        self.assertEqual(table.keys_with_prefix(''), ['c', 'e'])
+        self.assertRaises(postfixhelper.ConfigError, table.merge, [entries[1], entries[1]])
+
+    def test_diff(self):
+        table = postfixhelper.PostfixTable('virtual-alias')
+        for i, key in enumerate(['a', 'b', 'c']):
+            table[key] = postfixhelper.TableEntry('user', [], i + 1)
+        other = {'a': postfixhelper.TableEntry('user', [], 7), 'c': postfixhelper.TableEntry('user', ['note'], 3),
+                 'd': postfixhelper.TableEntry('user', [], 4, True), '#': table['#']}
+        self.assertEqual(sorted(table.diff(other)), [('del', 'b', None), ('set', 'c', other['c']),
+                                                     ('set', 'd', other['d'])])
+        table.clear_changes()
+        for op in list(table.diff(other)):
+            self.assertTrue(table.apply(*op))
+        self.assertEqual(list(table.diff(other)), [])
+        self.assertEqual(table['c'].line_no, 3)
+        self.assertFalse(table.apply('del', 'b'))
+        # Only changes postmap sees, comments and deleted entries aren't in the map
+        self.assertEqual(table.delta(), ({}, ['b']))
+
+    def test_rollback(self):
+        table = postfixhelper.PostfixTable('virtual-alias')
+        table['a'] = postfixhelper.TableEntry('user', [], 1)
+        table['b'] = postfixhelper.TableEntry('user', [], 2)
+        table.clear_changes()
+        table['a'] = postfixhelper.TableEntry('other', [], 1)
+        table.begin()
+        table['a'] = postfixhelper.TableEntry('third', [], 1)
+        table['c'] = postfixhelper.TableEntry('user', [], 3)
+        del table['b']
+        table.rollback()
+        self.assertEqual(sorted(k for k in table if k not in ('#', None)), ['a', 'b'])
+        # Only the change made before begin() is left
+        self.assertEqual(table.delta(), ({'a': 'other'}, []))
+        table.clear_changes()
+        table.begin()
+        table['c'] = postfixhelper.TableEntry('user', [], 3)
+        table.rollback()
+        self.assertFalse(table.is_dirty())
+
+        # Nested journals
+        table.begin()
+        table['c'] = postfixhelper.TableEntry('user', [], 3)
+        table.begin()
+        table['c'] = postfixhelper.TableEntry('other', [], 3)
+        table['d'] = postfixhelper.TableEntry('user', [], 4)
+        table.rollback()
+        self.assertEqual((table['c'].value, 'd' in table), ('user', False))
+        table.begin()
+        table['e'] = postfixhelper.TableEntry('user', [], 5)
+        table.commit()
+        table.rollback()
+        self.assertEqual(sorted(k for k in table if k not in ('#', None)), ['a', 'b'])
+        self.assertFalse(table.is_dirty())
+
+    def test_sorted_entries(self):
+        table = postfixhelper.PostfixTable('virtual-alias')
+        for i, (key, value) in enumerate([('c', 'u2'), ('a', 'u1'), ('b', 'u2'), ('d', 'u1')]):
+            table[key] = postfixhelper.TableEntry(value, [], i + 1)
+        self.assertEqual([key for key, _ in table.sorted_entries()], ['a', 'd', 'c', 'b'])
+        self.assertEqual(table.key_width(), 1)
+
+        table['new'] = postfixhelper.TableEntry('u1', ['note'], sys.maxsize)
+        table['new2'] = postfixhelper.TableEntry('u0', [], sys.maxsize)
+        table['c'] = postfixhelper.TableEntry('u1', [], 1)
+        table['a'] = postfixhelper.TableEntry('u1', [], sys.maxsize)
+        table.del_entry('d', comment_out=True)
+        del table['b']
+        table['b'] = postfixhelper.TableEntry('u0', [], sys.maxsize)
+        table.begin()
+        table['longer-key'] = postfixhelper.TableEntry('u0', [], 2)
+        self.assertEqual(table.key_width(), 10)
+        table.rollback()
+        self.assertEqual([key for key, _ in table.sorted_entries()], ['new2', 'b', 'c', 'd', 'a', 'new'])
+        self.assertEqual(table.key_width(), 5)
+        # The same as sorting a copy of the table
+        self.assertEqual(table.serialize(), postfixhelper.PFTableSerializer.serialize(dict(table)))
+        self.assertEqual(table.serialize(original_order=True),
+                         postfixhelper.PFTableSerializer.serialize(dict(table), original_order=True))
+
+    def test_columnar_backend(self):
+        table = postfixhelper.PostfixTable('virtual-alias', backend='columnar')
+        table['testvar1'] = postfixhelper.TableEntry('testuser1', [], 999)
+        table.del_entry('testvar1', comment_out=True)
+        self.assertIsInstance(table._mapping, postfixhelper.ColumnarTable)
+        self.assertEqual(table['testvar1'], postfixhelper.TableEntry('testuser1', [], 999, True))
+
+    def test_mmap_backend(self):
+        table = postfixhelper.PostfixTable('virtual-alias', backend='mmap')
+        table['testvar1'] = postfixhelper.TableEntry('testuser1', [], 999)
+        self.assertIsInstance(table._mapping, postfixhelper.MappedTable)
+        self.assertEqual(table['testvar1'], postfixhelper.TableEntry('testuser1', [], 999))
+
 
 class TestApp(unittest.TestCase):
     def setUp(self):
@@ -241,6 +695,392 @@ class TestApp(unittest.TestCase):
         self.assertEqual(out.find('testalias'), -1)
         self.assertEqual(out.find('testsender'), -1)
 
+    def test_batch_save(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as file:
+            file.write('add testalias1 testsender\nadd testalias2 testsender1\nadd testalias3 nobody\n')
+        try:
+            args = self.parser.parse_args(['alias', 'batch', '--strict', '--save', path])
+            out = self.app.batch_aliases(args)
+            self.assertIn('3 operations, 1 failed.', out)
+            self.assertIn('No changes have been saved.', out)
+
+            # The strict run left nothing behind, so only the unknown user fails again
+            args = self.parser.parse_args(['alias', 'batch', '--save', path])
+            out = self.app.batch_aliases(args)
+            self.assertEqual(out.splitlines(), [
+                'Line 1: ok: add testalias1 testsender',
+                'Line 2: ok: add testalias2 testsender1',
+                "Line 3: error: User 'nobody' does not exist.",
+                '3 operations, 1 failed.',
+                'Successfully saved virtual-alias, sender-login-maps.',
+            ])
+        finally:
+            os.remove(path)
+        # Read the saved tables again
+        importlib.reload(postfixhelper)
+        postfixhelper.load_file_config(config_file=EMPTY_CONFIG)
+        aliases = postfixhelper.PFAliasConfig()
+        self.assertEqual(aliases.get_alias('testalias2').sender.value, 'testsender1')
+
+    def test_save_unchanged(self):
+        fc = self._use_postmap_stub()
+        out = self.app.delete_alias(self.parser.parse_args('alias del --save nonexisting'.split(' ')))
+        self.assertEqual(out, 'Nothing to save, the tables are unchanged.')
+
+        out = self.app.add_alias(self.parser.parse_args('alias add --save testalias testsender'.split(' ')))
+        self.assertEqual(out, 'Successfully saved virtual-alias, sender-login-maps.')
+        self._postmap_calls(fc['virtual-alias'])
+
+        # Only sender-login-maps changes
+        self.app._alias_config.delete_alias('testalias', virtual_alias=False)
+        out = self.app._save_alias_tables(self.parser.parse_args('alias del --save testalias'.split(' ')))
+        self.assertEqual(out, 'Successfully saved sender-login-maps.')
+        self.assertEqual(self._postmap_calls(fc['virtual-alias']), [])
+
+        # Changes which cancel each other out
+        self.app._alias_config.add_alias('testalias2', 'testsender')
+        self.app._alias_config.delete_alias('testalias2')
+        out = self.app._save_alias_tables(self.parser.parse_args('alias del --save testalias2'.split(' ')))
+        self.assertEqual(out, 'Nothing to save, the tables are unchanged.')
+
+    def test_list_filters(self):
+        for alias, user in [('b@one', 'testsender'), ('a@one', 'testsender1'), ('c@two', 'testsender')]:
+            self.app.add_alias(self.parser.parse_args(('alias add %s %s' % (alias, user)).split(' ')))
+        out = self.app.list_aliases(self.parser.parse_args('alias list --domain one'.split(' ')))
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ['b@one', 'a@one'])
+        out = self.app.list_aliases(self.parser.parse_args('alias list --user testsender --limit 1'.split(' ')))
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ['b@one'])
+
+        # Streamed aliases come in key order
+        out = self.app.list_aliases(self.parser.parse_args('alias list --stream --offset 1'.split(' ')))
+        self.assertIsInstance(out, types.GeneratorType)
+        lines = list(out)
+        self.assertEqual(lines[0].split(), ['Alias:', 'Inbox:', 'Sender:'])
+        self.assertEqual(lines[2], '%-40s %-40s %s' % ('b@one', 'testsender', 'testsender'))
+        self.assertEqual([line.split()[0] for line in lines[2:]], ['b@one', 'c@two'])
+        out = self.app.list_aliases(self.parser.parse_args('alias list --stream --domain one'.split(' ')))
+        self.assertEqual([line.split()[0] for line in list(out)[2:]], ['a@one', 'b@one'])
+
+        # The previews of add and deluser list all aliases, not those of their user argument
+        out = self.app.add_alias(self.parser.parse_args('alias add d@two testsender1'.split(' ')))
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ['b@one', 'c@two', 'a@one', 'd@two'])
+        out = self.app.delete_alias_user(self.parser.parse_args('alias deluser testsender'.split(' ')))
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ['a@one', 'd@two'])
+        # Negative counts are usage errors
+        for option in ('--limit', '--offset'):
+            err = io.StringIO()
+            with contextlib.redirect_stderr(err):
+                self.assertRaises(SystemExit, self.parser.parse_args, ['alias', 'list', option, '-1'])
+            self.assertIn("-1 isn't 0 or more.", err.getvalue())
+
+    def test_export_import(self):
+        fc = self._use_postmap_stub()
+        with open(fc['virtual-alias'], 'w') as file:
+            file.write('# Header\n\n# Note\na1 testsender\n#-- a2 testsender1\na3 testsender\n# Footer\n')
+        args = self.parser.parse_args('export --table virtual-alias'.split(' '))
+        rows = [json.loads(line) for line in self.app.export_tables(args)]
+        self.assertEqual(rows[0], {'table': 'virtual-alias', 'kind': 'header', 'key': None, 'value': None,
+                                   'deleted': False, 'comment': ['Header']})
+        self.assertEqual(rows[1], {'table': 'virtual-alias', 'kind': 'entry', 'key': 'a1', 'value': 'testsender',
+                                   'deleted': False, 'comment': ['Note']})
+        self.assertEqual([(r['key'], r['deleted']) for r in rows[2:4]], [('a2', True), ('a3', False)])
+        self.assertEqual((rows[4]['kind'], rows[4]['comment']), ('footer', ['Footer']))
+
+        args = self.parser.parse_args('export --format csv --table virtual-alias'.split(' '))
+        lines = list(self.app.export_tables(args))
+        self.assertEqual(lines[0], 'table,kind,key,value,deleted,comment')
+        self.assertEqual(lines[2], 'virtual-alias,entry,a1,testsender,0,Note')
+        self.assertEqual([r._asdict() for r in postfixhelper.read_export(lines, 'csv')][1]['entry'],
+                         postfixhelper.TableEntry('testsender', ['Note'], sys.maxsize))
+
+        # Unchanged rows change nothing, the entries have to be sorted by key
+        path = os.path.join(tempfile.mkdtemp(), 'import')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as file:
+            file.write('\n'.join(json.dumps(r) for r in rows))
+        out = self.app.import_tables(self.parser.parse_args(['import', path]))
+        self.assertEqual(out, 'virtual-alias: 0 added, 0 changed, 0 removed.')
+        with open(path, 'w') as file:
+            file.write('\n'.join(json.dumps(r) for r in reversed(rows)))
+        self.assertRaisesRegex(postfixhelper.ConfigError, "Key 'a2' isn't sorted", self.app.import_tables,
+                               self.parser.parse_args(['import', path]))
+
+        rows[3]['value'] = 'testsender1'
+        rows[4]['comment'] = ['New footer']
+        rows[2] = dict(rows[1], key='a0')
+        del rows[1]
+        with open(path, 'w') as file:
+            file.write('\n'.join(json.dumps(r) for r in rows))
+        out = self.app.import_tables(self.parser.parse_args(['import', '--replace', '--save', path]))
+        self.assertEqual(out.splitlines()[0], 'virtual-alias: 1 added, 2 changed, 2 removed.')
+        self.assertEqual(out.splitlines()[-1], 'Successfully saved virtual-alias.')
+        with open(fc['virtual-alias']) as file:
+            self.assertEqual(file.read().split('\n')[-3:], ['a3              testsender1', '# New footer', ''])
+        self.assertEqual(sorted(k for k in self.app._alias_config._virtual_alias if k not in ('#', None)),
+                         ['a0', 'a3'])
+
+        # Errors leave the tables unchanged
+        with open(path, 'w') as file:
+            file.write('{"table": "virtual-alias", "key": "a4", "value": "x"}\n'
+                       '{"table": "virtual-mailbox-users", "key": "u", "value": "OK"}\n'
+                       '{"table": "virtual-mailbox-users", "key": "u", "value": "OK"}\n')
+        args = self.parser.parse_args(['import', path])
+        self.assertRaisesRegex(postfixhelper.ConfigError, 'virtual-mailbox-users', self.app.import_tables, args)
+        self.assertNotIn('a4', self.app._alias_config._virtual_alias)
+        with open(path, 'w') as file:
+            file.write('{"table": "virtual-alias", "key": "a4"}\n')
+        self.assertRaisesRegex(postfixhelper.ConfigError, 'Line 1', self.app.import_tables, args)
+        with open(path, 'w') as file:
+            file.write('{"table": "virtual-alias", "key": "a4", "value": "x"}\n'
+                       '{"table": "virtual-mailbox-users", "key": "u", "value": "OK"}\n'
+                       '{"table": "virtual-alias", "key": "a5", "value": "x"}\n')
+        self.assertRaisesRegex(postfixhelper.ConfigError, 'follow each other', self.app.import_tables, args)
+        self.assertNotIn('a4', self.app._alias_config._virtual_alias)
+
+        # Export shows the tables as they are in memory, unsaved changes included
+        self.app.add_alias(self.parser.parse_args('alias add a1 testsender'.split(' ')))
+        args = self.parser.parse_args('export --table virtual-alias'.split(' '))
+        self.assertEqual([json.loads(line)['key'] for line in self.app.export_tables(args)],
+                         [None, 'a0', 'a1', 'a3', None])
+
+    def test_export_import_csv(self):
+        fc = self._use_postmap_stub()
+        with open(fc['virtual-alias'], 'w') as file:
+            file.write('# Header\n\n# First line\n# Second line\na1 testsender\n')
+        args = self.parser.parse_args('export --format csv --table virtual-alias'.split(' '))
+        path = os.path.join(tempfile.mkdtemp(), 'import.csv')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as file:
+            file.write('\n'.join(self.app.export_tables(args)) + '\n')
+        # Comments with more than one line are quoted
+        with open(path) as file:
+            rows = list(postfixhelper.read_export(file, 'csv'))
+        self.assertEqual([(row.key, row.entry.comment) for row in rows],
+                         [('#', ['Header']), ('a1', ['First line', 'Second line'])])
+        out = self.app.import_tables(self.parser.parse_args(['import', '--format', 'csv', path]))
+        self.assertEqual(out, 'virtual-alias: 0 added, 0 changed, 0 removed.')
+
+    def test_diff_apply_patch(self):
+        fc = self._use_postmap_stub()
+        old = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, old)
+        for name in ('virtual-alias', 'sender-login-maps'):
+            shutil.copy(fc[name], old)
+        self.app.add_alias(self.parser.parse_args('alias add newalias testsender1 --comment Note'.split(' ')))
+        args = self.parser.parse_args(['diff', '--table', 'virtual-alias', '--table', 'sender-login-maps', old])
+        lines = list(self.app.diff_tables(args))
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'op': 'set', 'table': 'virtual-alias', 'key': 'newalias', 'value': 'testsender1',
+                           'comment': ['Note']},
+                          {'op': 'set', 'table': 'sender-login-maps', 'key': 'newalias', 'value': 'testsender1',
+                           'comment': ['Note']}])
+        args = self.parser.parse_args(['diff', '--table', 'virtual-alias', fc['virtual-alias'],
+                                       os.path.join(old, os.path.basename(fc['virtual-alias']))])
+        self.assertEqual(list(self.app.diff_tables(args)), [])
+        args = self.parser.parse_args(['diff', fc['virtual-alias']])
+        self.assertRaises(postfixhelper.ConfigError, self.app.diff_tables, args)
+
+        # Another node with the old tables gets only the changes
+        postfixhelper.CONFIG['postmap-incremental-threshold'] = 1
+        self.app._alias_config._virtual_alias._initialize()
+        self.app._alias_config._sender_login_maps._initialize()
+        patch = os.path.join(old, 'patch')
+        with open(patch, 'w') as file:
+            file.write('\n'.join(lines + ['{"op": "del", "table": "virtual-alias", "key": "missing"}']))
+        out = self.app.apply_patch(self.parser.parse_args(['apply-patch', '--save', patch]))
+        self.assertEqual(out.splitlines(), ['virtual-alias: 1 of 2 changes applied.',
+                                            'sender-login-maps: 1 of 1 changes applied.',
+                                            'Successfully saved virtual-alias, sender-login-maps.'])
+        self.assertEqual(self._postmap_calls(fc['virtual-alias']),
+                         [{'args': ['-i', '-r'], 'stdin': 'newalias testsender1\n'}])
+        self.assertEqual(self.app._alias_config._virtual_alias['newalias'].comment, ['Note'])
+        out = self.app.apply_patch(self.parser.parse_args(['apply-patch', '--save', patch]))
+        self.assertEqual(out.splitlines()[-1], 'Nothing to save, the tables are unchanged.')
+
+        with open(patch, 'w') as file:
+            file.write('{"op": "set", "table": "virtual-alias", "key": "x", "value": "y"}\n{"op": "move"}\n')
+        self.assertRaisesRegex(postfixhelper.ConfigError, 'Line 2', self.app.apply_patch,
+                               self.parser.parse_args(['apply-patch', patch]))
+        self.assertNotIn('x', self.app._alias_config._virtual_alias)
+
+    def test_save_timings(self):
+        fc = self._use_postmap_stub()
+        postfixhelper.timings.TIMINGS.start(memory=False)
+        self.addCleanup(postfixhelper.timings.TIMINGS.stop)
+        self.app.add_alias(self.parser.parse_args('alias add --save testalias testsender'.split(' ')))
+        phases = postfixhelper.timings.TIMINGS.stop()['phases']
+        self.assertEqual([(p['name'], p.get('file')) for p in phases if p['name'] != 'parse'],
+                         [('serialize', fc['virtual-alias']), ('write', fc['virtual-alias']),
+                          ('postmap', fc['virtual-alias']), ('serialize', fc['sender-login-maps']),
+                          ('write', fc['sender-login-maps']), ('postmap', fc['sender-login-maps'])])
+
+    def test_cdb_map_writer(self):
+        postfixhelper.CONFIG['map-writer'] = 'cdb'
+        postfixhelper.CONFIG['postmap'] = '/nonexisting/postmap'
+        fc = postfixhelper.load_file_config()
+        self.addCleanup(os.remove, fc['virtual-alias'] + '.cdb')
+        self.addCleanup(os.remove, fc['sender-login-maps'] + '.cdb')
+        self.app.add_alias(self.parser.parse_args('alias add --save TestAlias testsender'.split(' ')))
+        self.app.add_alias(self.parser.parse_args('alias add --save testalias2 testsender1'.split(' ')))
+        self.app.delete_alias(self.parser.parse_args('alias del --save --comment-out testalias2'.split(' ')))
+        reader = cdb.CdbReader(fc['virtual-alias'] + '.cdb')
+        self.assertEqual(reader.get('testalias'), 'testsender')
+        self.assertIsNone(reader.get('testalias2'))
+        self.assertIsNone(reader.get('#'))
+
+    def _use_postmap_stub(self):
+        postfixhelper.CONFIG['postmap'] = os.path.abspath(POSTMAP_STUB)
+        fc = postfixhelper.load_file_config()
+        for name in ('virtual-alias', 'sender-login-maps'):
+            with open(fc[name] + '.db', 'w'):
+                pass
+        self.addCleanup(self._remove_postmap_files, fc)
+        return fc
+
+    @staticmethod
+    def _remove_postmap_files(fc):
+        for name in ('virtual-alias', 'sender-login-maps'):
+            for suffix in ('.db', '.log'):
+                if os.path.exists(fc[name] + suffix):
+                    os.remove(fc[name] + suffix)
+
+    @staticmethod
+    def _postmap_calls(path):
+        if not os.path.exists(path + '.log'):
+            return []
+        with open(path + '.log') as log:
+            calls = [json.loads(line) for line in log]
+        os.remove(path + '.log')
+        return calls
+
+    def test_failed_postmap(self):
+        fc = self._use_postmap_stub()
+        self.app.add_alias(self.parser.parse_args('alias add newalias testsender1'.split(' ')))
+        with open(fc['virtual-alias'] + '.fail', 'w'):
+            pass
+        self.assertRaisesRegex(RuntimeError, 'Return code', self.app.save_alias_tables)
+        # The file is written already, the map is built on the next try
+        self.assertEqual(self._postmap_calls(fc['virtual-alias']), [])
+        self.assertTrue(self.app._alias_config._virtual_alias.is_dirty())
+        self.assertEqual(self.app.save_alias_tables(), 'Successfully saved virtual-alias, sender-login-maps.')
+        self.assertEqual(len(self._postmap_calls(fc['virtual-alias'])), 1)
+        self.assertFalse(self.app._alias_config._virtual_alias.is_dirty())
+
+    def test_incremental_postmap(self):
+        fc = self._use_postmap_stub()
+        for i in range(20):
+            self.app.add_alias(self.parser.parse_args(('alias add testalias%s testsender' % i).split(' ')))
+        self.app.add_alias(self.parser.parse_args('alias add --save testalias testsender'.split(' ')))
+        # Too many changes for an incremental update
+        self.assertEqual(self._postmap_calls(fc['virtual-alias']), [{'args': [], 'stdin': ''}])
+        self.assertEqual(self._postmap_calls(fc['sender-login-maps']), [{'args': [], 'stdin': ''}])
+
+        self.app.add_alias(self.parser.parse_args('alias add --save newalias testsender1'.split(' ')))
+        self.assertEqual(self._postmap_calls(fc['virtual-alias']),
+                         [{'args': ['-i', '-r'], 'stdin': 'newalias testsender1\n'}])
+        self._postmap_calls(fc['sender-login-maps'])
+
+        self.app.delete_alias(self.parser.parse_args('alias del --save --comment-out testalias1'.split(' ')))
+        self.assertEqual(self._postmap_calls(fc['sender-login-maps']),
+                         [{'args': ['-d', '-'], 'stdin': 'testalias1\n'}])
+
+    def test_concurrent_save(self):
+        fc = self._use_postmap_stub()
+        self.app.add_alias(self.parser.parse_args('alias add --save testalias testsender'.split(' ')))
+        self.app.add_alias(self.parser.parse_args('alias add mine testsender'.split(' ')))
+        self._postmap_calls(fc['virtual-alias'])
+        # Another process saves its own alias in the meantime
+        with open(fc['virtual-alias'], 'a') as file:
+            file.write('theirs testsender1\n')
+        out = self.app.save_alias_tables()
+        self.assertEqual(out, 'Successfully saved virtual-alias, sender-login-maps.')
+        with open(fc['virtual-alias']) as file:
+            data = file.read()
+        self.assertEqual([line.split()[0] for line in data.splitlines() if line and not line.startswith('#')],
+                         ['testalias', 'mine', 'theirs'])
+        self.assertEqual(self._postmap_calls(fc['virtual-alias']), [{'args': [], 'stdin': ''}])
+        self.assertFalse(self.app._alias_config._virtual_alias.changed_on_disk(fc['virtual-alias']))
+        self.assertEqual([f for f in os.listdir(os.path.dirname(fc['virtual-alias'])) if f.startswith('.empty_')],
+                         [])
+
+        # Both changed the same alias
+        self.app.add_alias(self.parser.parse_args('alias add other testsender'.split(' ')))
+        self.app.delete_alias(self.parser.parse_args('alias del theirs'.split(' ')))
+        with open(fc['virtual-alias'], 'w') as file:
+            file.write(data.replace('testsender1', 'testsender'))
+        self.assertRaisesRegex(postfixhelper.ConflictError, 'conflicting changes to theirs',
+                               self.app.save_alias_tables)
+        self.assertNotIn('theirs', self.app._alias_config._virtual_alias)
+        self.assertIn('other', self.app._alias_config._virtual_alias)
+
+    def test_lock_file(self):
+        import fcntl
+        path = os.path.join(tempfile.mkdtemp(), 'table')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        # Readers don't create the lock file
+        with postfixhelper.lock_file(path):
+            self.assertFalse(os.path.exists(path + '.lock'))
+        with postfixhelper.lock_file(path, exclusive=True):
+            fd = os.open(path + '.lock', os.O_RDONLY)
+            self.addCleanup(os.close, fd)
+            self.assertRaises(BlockingIOError, fcntl.flock, fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+    def test_lock_file_threads(self):
+        import threading
+        path = os.path.join(tempfile.mkdtemp(), 'table')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        locked = threading.Event()
+
+        def lock():
+            with postfixhelper.lock_file(path, exclusive=True):
+                locked.set()
+        with postfixhelper.lock_file(path, exclusive=True):
+            # The same thread may lock again, another one has to wait
+            with postfixhelper.lock_file(path, exclusive=True):
+                pass
+            thread = threading.Thread(target=lock)
+            thread.start()
+            self.assertFalse(locked.wait(0.05))
+        thread.join()
+        self.assertTrue(locked.is_set())
+
+    def test_write_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        target = os.path.join(directory, 'table')
+        link = os.path.join(directory, 'link')
+        with open(target, 'w') as file:
+            file.write('old\n')
+        os.chmod(target, 0o640)
+        os.symlink(target, link)
+        if os.geteuid() == 0:
+            os.chown(target, 1234, 1234)
+        postfixhelper.write_file(link, 'new\n')
+        # The link stays and the file it points to is replaced
+        self.assertTrue(os.path.islink(link))
+        with open(target) as file:
+            self.assertEqual(file.read(), 'new\n')
+        stat = os.stat(target)
+        self.assertEqual(stat.st_mode & 0o777, 0o640)
+        if os.geteuid() == 0:
+            self.assertEqual((stat.st_uid, stat.st_gid), (1234, 1234))
+        self.assertEqual(sorted(os.listdir(directory)), ['link', 'table'])
+
+    def test_incremental_postmap_without_map(self):
+        fc = self._use_postmap_stub()
+        postfixhelper.CONFIG['postmap-incremental-threshold'] = 1
+        os.remove(fc['virtual-alias'] + '.db')
+        # cdb maps can't be updated in place
+        with open(fc['virtual-alias'] + '.cdb', 'w'):
+            pass
+        self.addCleanup(os.remove, fc['virtual-alias'] + '.cdb')
+        self.app.add_alias(self.parser.parse_args('alias add --save newalias testsender1'.split(' ')))
+        self.assertEqual(self._postmap_calls(fc['virtual-alias']), [{'args': [], 'stdin': ''}])
+        self.assertEqual(self._postmap_calls(fc['sender-login-maps']),
+                         [{'args': ['-i', '-r'], 'stdin': 'newalias testsender1\n'}])
+
     def test_del_user_alias(self):
         args = self.parser.parse_args('alias add --save testalias1 testsender'.split(' '))
         self.app.add_alias(args)
@@ -260,3 +1100,45 @@ class TestApp(unittest.TestCase):
         self.assertEqual(out.find('testalias2'), -1)
         self.assertEqual(out.find('testalias3'), -1)
         self.assertEqual(out.find('testsender'), -1)
+
+    def test_del_user_alias_fresh_table(self):
+        for alias in ('testalias1', 'testalias2'):
+            self.app.add_alias(self.parser.parse_args(['alias', 'add', '--save', alias, 'testsender']))
+        # A new process, the tables are only loaded by deluser
+        importlib.reload(postfixhelper)
+        postfixhelper.load_file_config(config_file=EMPTY_CONFIG)
+        app = postfixhelper.App()
+        app.delete_alias_user(self.parser.parse_args('alias deluser --save testsender'.split(' ')))
+        out = app.list_aliases(self.list_alias)
+        self.assertEqual(out.find('testalias'), -1)
+        self.assertEqual(out.find('testsender'), -1)
+
+class TestStartup(unittest.TestCase):
+    def tearDown(self):
+        unload_config()
+
+    def test_deferred_imports(self):
+        code = 'import sys, postfixhelper; print(" ".join(m for m in sys.argv[1:] if m in sys.modules))'
+        modules = ['subprocess', 'shutil', 'yaml', 'inspect', 'logging', 'tracemalloc', 'hashlib', 'cache', 'cdb']
+        out = subprocess.run([sys.executable, '-c', code] + modules, stdout=subprocess.PIPE, check=True)
+        self.assertEqual(out.stdout.decode().split(), [])
+
+    def test_lazy_tables(self):
+        self.assertFalse(hasattr(postfixhelper.PostfixTable, '_instances'))
+        load_test_config()
+        app = postfixhelper.App()
+        app.list_aliases(argparse.Namespace(as_saved=False))
+        loaded = [name for name, table in postfixhelper.PostfixTable._instances.items() if '_mapping' in vars(table)]
+        self.assertEqual(sorted(loaded), ['sender-login-maps', 'virtual-alias'])
+        self.assertIs(postfixhelper.PFAliasConfig._users, postfixhelper.PostfixTable('virtual-mailbox-users'))
+
+    def test_pruned_parser(self):
+        for argv in ['alias list', '--config-file x --no-cache alias add --comment c a u', '--socket s check',
+                     'serve --listen x --delay 2', '--profile p alias batch --strict f']:
+            argv = argv.split(' ')
+            full = postfixhelper.create_args_parser(help.Help).parse_args(argv)
+            self.assertEqual(postfixhelper.parse_args(help.Help, ['postfixhelper'] + argv), full)
+        # Only the selected command gets its arguments
+        pruned = postfixhelper.create_args_parser(help.Help, ['check'])
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, pruned.parse_args, ['alias', 'add', 'a', 'u'])
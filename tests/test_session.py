@@ -0,0 +1,202 @@
+import unittest
+import importlib
+import subprocess
+import sys
+import io
+import tempfile
+import threading
+import shutil
+import time
+import os
+import postfixhelper
+import session
+import help
+from tests.test_pfhelper import POSTMAP_STUB
+
+
+def write_instance(directory, aliases=()):
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'config.yaml'), 'w') as file:
+        file.write('postmap: %s\nfilesystem:\n  files:\n' % os.path.abspath(POSTMAP_STUB))
+        for name in postfixhelper.TABLE_NAMES:
+            file.write('    %s: ./%s\n' % (name, name))
+    tables = {
+        'virtual-alias': ''.join('%s testuser\n' % alias for alias in aliases),
+        'sender-login-maps': ''.join('%s testuser\n' % alias for alias in aliases),
+        'virtual-mailbox-users': 'testuser OK\n',
+        'virtual-mailbox-domains': '',
+    }
+    for name, data in tables.items():
+        with open(os.path.join(directory, name), 'w') as file:
+            file.write(data)
+    return os.path.join(directory, 'config.yaml')
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        importlib.reload(postfixhelper)
+        self.dir = tempfile.mkdtemp()
+        self.config_a = write_instance(os.path.join(self.dir, 'a'), ['a1'])
+        self.config_b = write_instance(os.path.join(self.dir, 'b'), ['b1'])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        importlib.reload(postfixhelper)
+
+    def test_independent_sessions(self):
+        a = session.Session(self.config_a)
+        b = session.Session(self.config_b)
+        self.assertIs(a.app()._alias_config.session, a)
+        self.assertEqual([alias.alias for alias in a.alias_config().iter_aliases()], ['a1'])
+        self.assertEqual([alias.alias for alias in b.alias_config().iter_aliases()], ['b1'])
+        self.assertIsNot(a.table('virtual-alias'), b.table('virtual-alias'))
+        self.assertIs(a.table('virtual-alias'), a.table('virtual-alias'))
+        # The global config and tables stay untouched
+        self.assertIsNone(postfixhelper.CONFIG)
+        self.assertFalse(hasattr(postfixhelper.PostfixTable, '_instances'))
+
+        with a.writing() as alias_config:
+            alias_config.add_alias('a2', 'testuser')
+            self.assertEqual(a.save(), 'Successfully saved virtual-alias, sender-login-maps.')
+        with open(os.path.join(self.dir, 'a', 'virtual-alias')) as file:
+            self.assertIn('a2', file.read())
+        self.assertNotIn('a2', b.table('virtual-alias'))
+
+    def test_rollback(self):
+        s = session.Session(self.config_a)
+        with self.assertRaises(postfixhelper.ConfigError):
+            with s.writing() as alias_config:
+                alias_config.add_alias('a2', 'testuser')
+                alias_config.add_alias('a3', 'nobody')
+        with s.reading() as alias_config:
+            self.assertEqual([alias.alias for alias in alias_config.iter_aliases()], ['a1'])
+        self.assertFalse(s.table('virtual-alias').is_dirty())
+
+    def test_nested_rollback(self):
+        s = session.Session(self.config_a)
+        add = postfixhelper.BatchOperation(1, 'add', {'alias': 'a3', 'user': 'testuser'})
+        fail = postfixhelper.BatchOperation(2, 'add', {'alias': 'a4', 'user': 'nobody'})
+        with self.assertRaises(RuntimeError):
+            with s.writing() as alias_config:
+                alias_config.add_alias('a2', 'testuser')
+                # A failed atomic batch only undoes its own changes, a committed one is kept until the block fails
+                alias_config.apply_batch([add, fail], atomic=True)
+                self.assertEqual([alias.alias for alias in alias_config.iter_aliases()], ['a1', 'a2'])
+                alias_config.apply_batch([add], atomic=True)
+                self.assertEqual([alias.alias for alias in alias_config.iter_aliases()], ['a1', 'a2', 'a3'])
+                raise RuntimeError()
+        with s.reading() as alias_config:
+            self.assertEqual([alias.alias for alias in alias_config.iter_aliases()], ['a1'])
+        self.assertFalse(s.table('virtual-alias').is_dirty())
+        self.assertFalse(s.table('sender-login-maps').is_dirty())
+
+    def test_pool(self):
+        pool = session.SessionPool()
+        with pool.reading(self.config_a) as alias_config:
+            table = alias_config._virtual_alias
+        self.assertIs(pool.session(self.config_a), pool.session(os.path.join(self.dir, 'a', '..', 'a',
+                                                                             'config.yaml')))
+        with pool.reading(self.config_a) as alias_config:
+            self.assertIs(alias_config._virtual_alias._mapping, table._mapping)
+        # Tables saved by someone else are loaded again
+        time.sleep(0.01)
+        with open(os.path.join(self.dir, 'a', 'virtual-alias'), 'a') as file:
+            file.write('a9 testuser\n')
+        with pool.reading(self.config_a) as alias_config:
+            self.assertIn('a9', alias_config._virtual_alias)
+        self.assertEqual(len(pool), 1)
+
+    def test_concurrent_requests(self):
+        pool = session.SessionPool()
+        errors = []
+
+        def work(i):
+            try:
+                config_file = self.config_a if i % 2 else self.config_b
+                with pool.writing(config_file) as alias_config:
+                    alias_config.add_alias('t%s' % i, 'testuser')
+                with pool.reading(config_file) as alias_config:
+                    self.assertIn('t%s' % i, alias_config._virtual_alias)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(k for k in pool.session(self.config_a).table('virtual-alias') if k),
+                         sorted(['a1'] + ['t%s' % i for i in range(1, 20, 2)]))
+
+    def test_run_multi(self):
+        write_instance(os.path.join(self.dir, 'c'))
+        os.remove(os.path.join(self.dir, 'c', 'virtual-mailbox-users'))
+        pattern = os.path.join(self.dir, '*', 'config.yaml')
+        configs = session.expand_configs([pattern, self.config_a])
+        self.assertEqual(configs, [self.config_a, self.config_b, os.path.join(self.dir, 'c', 'config.yaml')])
+        self.assertRaises(postfixhelper.ConfigError, session.expand_configs, [os.path.join(self.dir, 'x*')])
+
+        parser = postfixhelper.create_args_parser(help.Help)
+        args = parser.parse_args(['--multi-config', pattern, 'alias', 'add', '--save', 'new', 'testuser'])
+        results = session.run_multi(configs, args, jobs=2)
+        self.assertEqual([r.config_file for r in results], configs)
+        # The commands run for a config are part of its output
+        for name, result in zip('ab', results):
+            postmap = '%s %s' % (os.path.abspath(POSTMAP_STUB), os.path.join(self.dir, name))
+            self.assertEqual(result.output.splitlines(),
+                             ['Executed: %s/virtual-alias' % postmap, 'Executed: %s/sender-login-maps' % postmap,
+                              'Successfully saved virtual-alias, sender-login-maps.'])
+        self.assertIsInstance(results[2].error, FileNotFoundError)
+        for name in ('a', 'b'):
+            with open(os.path.join(self.dir, name, 'virtual-alias')) as file:
+                self.assertIn('new', file.read())
+        out, err = io.StringIO(), io.StringIO()
+        self.assertEqual(session.print_results(results, out, err), 1)
+        self.assertEqual(out.getvalue().splitlines()[:4],
+                         ['==> %s <==' % self.config_a] + results[0].output.splitlines())
+        self.assertEqual(err.getvalue().splitlines()[-1], '1 of 3 configs failed.')
+
+        args = parser.parse_args(['--multi-config', pattern, 'serve'])
+        self.assertRaises(postfixhelper.ConfigError, session.run_multi, configs, args)
+
+    def test_multi_config_cli(self):
+        pattern = os.path.join(self.dir, '*', 'config.yaml')
+        p = subprocess.run([sys.executable, 'postfixhelper.py', '--multi-config', pattern, '--jobs', '2', 'alias',
+                            'list', '--stream'], capture_output=True, text=True)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        lines = p.stdout.splitlines()
+        self.assertEqual(lines[0], '==> %s <==' % self.config_a)
+        self.assertEqual([line.split()[0] for line in lines if line.startswith(('a1', 'b1'))], ['a1', 'b1'])
+        p = subprocess.run([sys.executable, 'postfixhelper.py', '--multi-config', pattern, 'alias', 'add', 'x',
+                            'nobody'], capture_output=True, text=True)
+        self.assertEqual(p.returncode, 1)
+        self.assertIn('2 of 2 configs failed.', p.stderr)
+
+    def test_rwlock(self):
+        lock = session.RWLock()
+        events = []
+        with lock.read():
+            writer = threading.Thread(target=lambda: lock.write().__enter__() or events.append('write'))
+            writer.start()
+            time.sleep(0.05)
+            self.assertEqual(events, [])
+        writer.join()
+        self.assertEqual(events, ['write'])
+
+    def test_rwlock_writer_reentrant(self):
+        lock = session.RWLock()
+        events = []
+        with lock.write():
+            with lock.write(), lock.read():
+                events.append('nested')
+            reader = threading.Thread(target=lambda: lock.read().__enter__() or events.append('read'))
+            reader.start()
+            time.sleep(0.05)
+            # The outer write still holds the lock
+            self.assertEqual(events, ['nested'])
+        reader.join()
+        self.assertEqual(events, ['nested', 'read'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+import tempfile
+import shutil
+import timings
+
+
+class TestTimings(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.timings = timings.Timings()
+
+    def tearDown(self):
+        self.timings.stop()
+        shutil.rmtree(self.dir)
+
+    def test_disabled(self):
+        with self.timings.phase('parse'):
+            pass
+        self.assertEqual(self.timings.phases, [])
+        self.assertIsNone(self.timings.stop())
+
+    def test_nested_phases(self):
+        self.timings.start()
+        with self.timings.phase('command', action='add_alias'):
+            with self.timings.phase('parse', table='virtual-alias'):
+                data = [str(i) for i in range(100000)]
+            del data
+            with self.timings.phase('serialize'):
+                pass
+        summary = self.timings.stop()
+        self.assertEqual([(p['name'], p['depth']) for p in summary['phases']],
+                         [('command', 0), ('parse', 1), ('serialize', 1)])
+        command, parse, serialize = summary['phases']
+        self.assertEqual(command['action'], 'add_alias')
+        self.assertEqual(parse['table'], 'virtual-alias')
+        self.assertGreater(parse['peak_bytes'], 1000000)
+        self.assertGreaterEqual(command['peak_bytes'], parse['peak_bytes'])
+        self.assertLess(serialize['peak_bytes'], parse['peak_bytes'])
+        self.assertGreaterEqual(summary['peak_bytes'], command['peak_bytes'])
+        self.assertGreaterEqual(command['seconds'], parse['seconds'] + serialize['seconds'])
+        self.assertFalse(self.timings.enabled)
+
+    def test_threads(self):
+        import threading
+        self.timings.start()
+        started = threading.Barrier(2)
+
+        def run():
+            with self.timings.phase('command'):
+                started.wait()
+                with self.timings.phase('parse'):
+                    started.wait()
+        with self.timings.phase('multi'):
+            thread = threading.Thread(target=run)
+            thread.start()
+            with self.timings.phase('command'):
+                started.wait()
+                with self.timings.phase('parse'):
+                    started.wait()
+            thread.join()
+        phases = self.timings.stop()['phases']
+        # Each thread nests its own phases
+        self.assertEqual(sorted((p['name'], p['depth'], 'thread' in p) for p in phases),
+                         [('command', 0, True), ('command', 1, False), ('multi', 0, False),
+                          ('parse', 1, True), ('parse', 2, False)])
+        self.assertTrue(all(p['peak_bytes'] is not None for p in phases))
+
+    def test_profile(self):
+        path = os.path.join(self.dir, 'run.prof')
+        self.timings.start(memory=False, profile_file=path)
+        with self.timings.phase('parse'):
+            pass
+        summary = self.timings.stop()
+        self.assertIsNone(summary['peak_bytes'])
+        self.assertIsNone(summary['phases'][0]['peak_bytes'])
+        self.assertEqual(summary['profile'], path)
+        self.assertTrue(os.path.getsize(path) > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
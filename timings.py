@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import time
+import _thread
+import contextlib
+
+__all__ = ['Timings', 'TIMINGS']
+
+
+class Timings(object):
+    # Records wall time and peak memory of nested phases. Does nothing until started, so the phases can stay
+    # in the code. tracemalloc is only imported once started, it's slow to import. Every thread has a stack of
+    # running phases of its own, phases of other threads than the one calling start() are marked with 'thread'.
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.profile_file = None
+        self._profiler = None
+        self._local = _thread._local()
+        self._stacks = []
+        self._lock = _thread.allocate_lock()
+        self._thread = None
+        self._start = None
+        self._started_tracing = False
+
+    def start(self, memory=True, profile_file=None):
+        import tracemalloc
+        self.enabled = True
+        self.phases = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.profile_file = profile_file
+        if profile_file:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        # The bottom frame tracks the peak of the whole run
+        current = 0
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+        self._local = _thread._local()
+        self._local.stack = [[current, current]]
+        self._stacks = [self._local.stack]
+        self._thread = _thread.get_ident()
+        self._start = time.perf_counter()
+
+    def stop(self):
+        # Returns the summary
+        if not self.enabled:
+            return None
+        import tracemalloc
+        total = time.perf_counter() - self._start
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_file)
+            self._profiler = None
+        peak = None
+        if tracemalloc.is_tracing():
+            self._update_peak()
+            peak = self._stacks[0][0][1] - self._stacks[0][0][0]
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        self.enabled = False
+        return {'total_seconds': total, 'peak_bytes': peak, 'profile': self.profile_file, 'phases': self.phases}
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = [[0, 0]]
+            with self._lock:
+                self._stacks.append(stack)
+        return stack
+
+    def _update_peak(self):
+        import tracemalloc
+        # tracemalloc has only one peak, so it is handed to the running phases of all threads before it is reset
+        with self._lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            for stack in self._stacks:
+                for frame in stack:
+                    frame[1] = max(frame[1], peak)
+            tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def phase(self, name, **info):
+        if not self.enabled:
+            yield
+            return
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            self._update_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            frame = [current, current]
+        else:
+            frame = [0, 0]
+        stack = self._get_stack()
+        result = dict(info, name=name, depth=len(stack) - 1)
+        if _thread.get_ident() != self._thread:
+            result['thread'] = _thread.get_ident()
+        self.phases.append(result)
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            result['seconds'] = time.perf_counter() - start
+            if tracing:
+                self._update_peak()
+            stack.pop()
+            # Memory above what was allocated when the phase started
+            result['peak_bytes'] = frame[1] - frame[0] if tracing else None
+
+
+TIMINGS = Timings()